@@ -103,6 +103,13 @@ class Controller:
     def purge_files(self):
         self.__model.purge_files()
 
+    def rescan(self):
+        self.__model.rescan()
+
+    @property
+    def scan_interval(self):
+        return self.__model.scan_interval
+
     @property
     def subdirectory(self):
         return self.__model.subdirectory
@@ -317,10 +324,15 @@ class Controller:
                             field_name = self.__model.EXIF_TO_FIELD[key]
                             image_attr[key] = pics[0].__dict__[field_name] #TODO nicer using namedtuple for Pic
                     self.publish_state(pics[0].fname, image_attr)
-            self.__model.pause_looping = self.__viewer.is_in_transition()
+            self.__model.pause_looping(self.__viewer.is_in_transition(),
+                                       fade_time + self.__viewer.TRANSITION_LEAD_SECONDS)
             (loop_running, skip_image) = self.__viewer.slideshow_is_running(pics, time_delay, fade_time, self.__paused)
             if not loop_running:
                 break
+            if pics is not None: # start preparing the following images while this one is showing
+                self.__viewer.prefetch(self.__model.get_upcoming_pics(self.__viewer.prefetch_num))
+                for (file_id, palette) in self.__viewer.get_found_palettes():
+                    self.__model.set_palette(file_id, palette)
             if skip_image:
                 self.__next_tm = 0
             self.__interface_peripherals.check_input()
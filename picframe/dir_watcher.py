@@ -0,0 +1,181 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+
+# constants from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+
+class InotifyWatcher:
+    """Watch a directory tree with the linux inotify API (via ctypes so there are no
+    extra dependencies) and collect the folders in which something has changed.
+
+    Raises OSError if inotify isn't available or the tree can't be watched, in which
+    case the caller should carry on polling.
+    """
+
+    def __init__(self, root, follow_links=False):
+        self.__logger = logging.getLogger("dir_watcher.InotifyWatcher")
+        self.__root = root
+        self.__follow_links = follow_links
+        self.__root_lost = False # root moved, deleted or unmounted so it needs watching again
+        self.__wd_to_dir = {}
+        self.__dir_to_wd = {}
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        self.__libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.__fd = self.__libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_init1 failed: " + os.strerror(err))
+        try:
+            self.__add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+
+    def get_changed_folders(self):
+        """Drain the pending events without blocking.
+
+        Returns a tuple (changed, removed, overflow) where changed is a set of folders
+        with new, modified or deleted content (including newly created folders), removed
+        is True if any folder has gone and overflow is True if events were lost, in which
+        case everything needs to be checked. That's also the case if the root folder has
+        been replaced (i.e. moved, deleted or remounted), when it's watched again as soon
+        as it exists.
+        """
+        changed = set()
+        removed = False
+        overflow = False
+        while True:
+            try:
+                buf = os.read(self.__fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not buf:
+                break
+            pos = 0
+            while pos + EVENT_HEADER.size <= len(buf):
+                (wd, mask, _cookie, name_len) = EVENT_HEADER.unpack_from(buf, pos)
+                name = buf[pos + EVENT_HEADER.size:pos + EVENT_HEADER.size + name_len].rstrip(b'\0')
+                pos += EVENT_HEADER.size + name_len
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                dir = self.__wd_to_dir.get(wd)
+                if dir == self.__root and mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    self.__root_lost = True
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED: # watch removed by the kernel i.e. folder deleted
+                    if dir is not None:
+                        self.__wd_to_dir.pop(wd, None)
+                        self.__dir_to_wd.pop(dir, None)
+                    continue
+                if dir is None:
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    removed = True
+                    continue
+                changed.add(dir)
+                if mask & IN_ISDIR:
+                    sub_dir = os.path.join(dir, os.fsdecode(name))
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        try:
+                            changed.update(self.__add_tree(sub_dir))
+                        except OSError as e:
+                            self.__logger.warning("Can't watch %s -> %s", sub_dir, e)
+                            overflow = True # fall back to checking everything
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        removed = True
+        if self.__root_lost and self.__watch_root_again():
+            overflow = True # for what's in it now
+        return (changed, removed, overflow)
+
+    def __watch_root_again(self):
+        # drop every watch, as the old ones may be for folders moved out of the tree along with the
+        # root, then watch the tree again if the root is back. Returns True if it is
+        for wd in list(self.__wd_to_dir):
+            self.__libc.inotify_rm_watch(self.__fd, wd) # fails harmlessly if the kernel has dropped it
+        self.__wd_to_dir.clear()
+        self.__dir_to_wd.clear()
+        if not os.path.isdir(self.__root):
+            return False
+        try:
+            self.__add_tree(self.__root)
+        except OSError as e:
+            self.__logger.warning("Can't watch %s -> %s", self.__root, e)
+            return False
+        self.__root_lost = False
+        return True
+
+    def __add_tree(self, top):
+        # add a watch for top and every (non hidden) folder below it, returns the folders added. If
+        # following links each real folder is only watched once, under the first path it was found by
+        added = []
+        visited = set()
+        for (dir, dirs, _files) in os.walk(top, followlinks=self.__follow_links):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            if os.path.basename(dir).startswith('.') or dir in self.__dir_to_wd:
+                continue
+            try:
+                dir_stat = os.stat(dir)
+            except OSError: # gone already
+                dirs[:] = []
+                continue
+            if (dir_stat.st_dev, dir_stat.st_ino) in visited: # symlink cycle
+                dirs[:] = []
+                continue
+            visited.add((dir_stat.st_dev, dir_stat.st_ino))
+            wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(dir), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOENT, errno.ENOTDIR): # gone already
+                    continue
+                raise OSError(err, "inotify_add_watch failed for {}: {} (if ENOSPC try increasing "
+                                   "fs.inotify.max_user_watches)".format(dir, os.strerror(err)))
+            old_dir = self.__wd_to_dir.get(wd) # same inode, already watched
+            if old_dir is not None:
+                if self.__is_same_folder(old_dir, dir_stat): # and still there i.e. dir is via a link to it
+                    dirs[:] = []
+                    continue
+                self.__dir_to_wd.pop(old_dir, None) # a watched folder has been moved
+            self.__wd_to_dir[wd] = dir
+            self.__dir_to_wd[dir] = wd
+            added.append(dir)
+        return added
+
+    def __is_same_folder(self, dir, dir_stat):
+        try:
+            old_stat = os.stat(dir)
+        except OSError:
+            return False
+        return (old_stat.st_dev, old_stat.st_ino) == (dir_stat.st_dev, dir_stat.st_ino)
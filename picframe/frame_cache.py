@@ -0,0 +1,114 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+from collections import OrderedDict
+
+from PIL import Image
+
+
+class FrameCache:
+    """Disk cache of the images prepared by TextureProvider (matted, paired, blurred edges etc)
+    so that pictures coming round again only need decoding before being made into a texture.
+
+    Images are stored in a sub folder of cache_dir named from a hash of config_key (the display
+    size and every setting that changes the result) so that changing the configuration starts a
+    new cache and the old one is removed. RGB images are stored as high quality JPEG and RGBA
+    (blurred edges) as quickly compressed PNG. The least recently used are removed once the total
+    size goes over max_mb.
+
+    All methods are called from the same (prefetch) thread.
+    """
+    VERSION = 1 # increment when the preparation of images changes to ignore existing caches
+    SUB_FOLDER_PREFIX = 'frames_'
+    SUB_FOLDER_RE = re.compile(SUB_FOLDER_PREFIX + '[0-9a-f]{40}') # only folders named exactly like this are
+                                                                   # ever removed, cache_dir may be shared
+
+    def __init__(self, cache_dir, max_mb, config_key):
+        self.__logger = logging.getLogger("frame_cache.FrameCache")
+        self.__max_bytes = int(max_mb * 1024 * 1024)
+        self.__index = OrderedDict() # hash -> (file name, size), least recently used first
+        self.__total_bytes = 0
+        root = os.path.expanduser(cache_dir)
+        self.__dir = os.path.join(root, FrameCache.SUB_FOLDER_PREFIX + self.__hash((FrameCache.VERSION, config_key)))
+        try:
+            os.makedirs(self.__dir, exist_ok=True)
+            for entry in os.scandir(root): # made with a different configuration so of no use now
+                if (entry.is_dir() and FrameCache.SUB_FOLDER_RE.fullmatch(entry.name)
+                        and entry.path != self.__dir):
+                    self.__logger.info("Removing out of date frame cache %s", entry.path)
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            files = []
+            for entry in os.scandir(self.__dir):
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.name, stat.st_size))
+            for (_mtime, name, size) in sorted(files):
+                self.__index[os.path.splitext(name)[0]] = (name, size)
+                self.__total_bytes += size
+            self.__evict()
+        except OSError as e:
+            self.__logger.warning("Can't use frame cache %s -> %s", self.__dir, e)
+            self.__dir = None
+
+    def get(self, key):
+        """Returns the image stored for key or None"""
+        if self.__dir is None:
+            return None
+        digest = self.__hash(key)
+        found = self.__index.get(digest)
+        if found is None:
+            return None
+        path = os.path.join(self.__dir, found[0])
+        try:
+            im = Image.open(path)
+            im.load()
+            os.utime(path) # keep the LRU order for next time
+        except OSError as e:
+            self.__logger.warning("Can't read %s -> %s", path, e)
+            self.__remove(digest)
+            return None
+        self.__index.move_to_end(digest)
+        return im
+
+    def put(self, key, im):
+        if self.__dir is None:
+            return
+        digest = self.__hash(key)
+        if im.mode == 'RGB':
+            (name, kwargs) = (digest + '.jpg', {'format': 'JPEG', 'quality': 95, 'subsampling': 0})
+        elif im.mode == 'RGBA':
+            (name, kwargs) = (digest + '.png', {'format': 'PNG', 'compress_level': 1})
+        else:
+            return
+        path = os.path.join(self.__dir, name)
+        try:
+            im.save(path + '.tmp', **kwargs)
+            os.replace(path + '.tmp', path) # so a part written file is never read
+            size = os.path.getsize(path)
+        except OSError as e:
+            self.__logger.warning("Can't write %s -> %s", path, e)
+            return
+        self.__remove(digest, delete=False)
+        self.__index[digest] = (name, size)
+        self.__total_bytes += size
+        self.__evict()
+
+    def __evict(self):
+        while self.__total_bytes > self.__max_bytes and self.__index:
+            self.__remove(next(iter(self.__index)))
+
+    def __remove(self, digest, delete=True):
+        found = self.__index.pop(digest, None)
+        if found is None:
+            return
+        self.__total_bytes -= found[1]
+        if delete:
+            try:
+                os.remove(os.path.join(self.__dir, found[0]))
+            except OSError:
+                pass
+
+    def __hash(self, key):
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
@@ -1,14 +1,18 @@
 import os
+import csv
 import json
-import urllib.request
+import math
+import http.client
+import urllib.parse
 import locale
 import logging
 import time
+import numpy as np
 
 URL = "https://nominatim.openstreetmap.org/reverse?format=geojson&lat={}&lon={}&zoom={}&email={}&accept-language={}"
 
 class GeoReverse:
-    def __init__(self, geo_key, zoom=18, key_list=None):
+    def __init__(self, geo_key, zoom=18, key_list=None, rate=1.0, url=URL):
         self.__logger = logging.getLogger("geo_reverse.GeoReverse")
         self.__geo_key = geo_key
         self.__zoom = zoom
@@ -23,24 +27,235 @@ class GeoReverse:
         #            (name, var) = line.partition('=')[::2]
         #            self.__geo_locations[name] = var.rstrip('\n')
         self.__language = locale.getlocale()[0][:2]
+        self.__url = url
+        self.__min_interval = 1.0 / rate if rate > 0 else 0.0 # nominatim allows at most one request a second
+        self.__last_request_tm = 0.0
+        self.__conn = None # kept open between requests
 
     def get_address(self, lat, lon):
+        """Returns the address text for lat, lon, "" if there is no address there or None if the
+        lookup failed (i.e. no network) and is worth trying again later.
+        """
         try:
-            with urllib.request.urlopen(URL.format(lat, lon, self.__zoom, self.__geo_key, self.__language),
-                                        timeout=3.0) as req:
-                    data = json.loads(req.read().decode())
-            adr = data['features'][0]['properties']['address']
-            # some experimentation might be needed to get a good set of alternatives in key_list
-            adr_list = []
-            if self.__key_list is not None:
-                for part in self.__key_list:
-                    for option in part:
-                        if option in adr:
-                            adr_list.append(adr[option])
-                            break # add just the first one from the options
-            else:
-                adr_list = adr.values()
-            return ", ".join(adr_list)
-        except Exception as e: #TODO return different thing for different exceptions
+            data = json.loads(self.__request(self.__url.format(lat, lon, self.__zoom,
+                                                               urllib.parse.quote(self.__geo_key), self.__language)))
+        except Exception as e:
             self.__logger.error("lat=%f, lon=%f -> %s", lat, lon, e)
+            return None
+        try:
+            adr = data['features'][0]['properties']['address']
+        except (KeyError, IndexError, TypeError): # i.e. {"error":"Unable to geocode"} in the middle of the sea
+            self.__logger.info("lat=%f, lon=%f -> no address", lat, lon)
+            return ""
+        return _format_address(adr, self.__key_list)
+
+    def close(self):
+        if self.__conn is not None:
+            self.__conn.close()
+            self.__conn = None
+
+    def __request(self, url):
+        # GET url over the kept-alive connection, no more often than the rate limit allows. A connection
+        # that the server has closed while idle is only noticed when it's used, so that gets one retry
+        wait_tm = self.__last_request_tm + self.__min_interval - time.monotonic()
+        if wait_tm > 0:
+            time.sleep(wait_tm)
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        for attempt in range(2):
+            if self.__conn is None:
+                conn_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+                self.__conn = conn_class(parts.netloc, timeout=3.0)
+            try:
+                self.__last_request_tm = time.monotonic()
+                self.__conn.request('GET', path, headers={'User-Agent': 'picframe'})
+                response = self.__conn.getresponse()
+                body = response.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                self.close()
+                if attempt > 0:
+                    raise
+                continue
+            except Exception:
+                self.close()
+                raise
+            if response.will_close:
+                self.close()
+            if response.status != 200:
+                raise http.client.HTTPException("HTTP status {} {}".format(response.status, response.reason))
+            return body.decode()
+
+
+
+class OfflineGeoReverse:
+    """Reverse geocoder using a local GeoNames gazetteer (i.e. cities1000.txt from
+    https://download.geonames.org/export/dump/) so that no network is needed. If admin1CodesASCII.txt
+    and countryInfo.txt are in the same folder they're used for the state and country names.
+
+    The places are held in a KD-tree of numpy arrays, built the first time get_address() is called,
+    of points on the unit sphere (so there's no problem with longitude wrapping round or converging
+    at the poles). The answer is made to look like nominatim's address so the same key_list can be used.
+    """
+    LEAF_SIZE = 32 # points searched by brute force at the bottom of the tree
+    MAX_DISTANCE = 50000.0 # metres, further than this from anywhere is treated as no address
+    EARTH_RADIUS = 6371000.0
+
+    def __init__(self, gazetteer_file, key_list=None):
+        self.__logger = logging.getLogger("geo_reverse.OfflineGeoReverse")
+        self.__gazetteer_file = os.path.expanduser(gazetteer_file)
+        self.__key_list = key_list
+        self.__points = None # (n, 3) float32 unit vectors in tree order
+        self.__split_axis = None # per tree node, heap numbered
+        self.__split_value = None
+        self.__places = None # (name, place type, state, country) in tree order
+        self.__max_chord2 = (2.0 * math.sin(OfflineGeoReverse.MAX_DISTANCE / OfflineGeoReverse.EARTH_RADIUS / 2.0)) ** 2
+
+    def get_address(self, lat, lon):
+        """As GeoReverse.get_address(), None is only returned if the gazetteer can't be loaded.
+        """
+        if self.__points is None:
+            try:
+                self.__load()
+            except Exception as e:
+                self.__logger.error("Can't load gazetteer %s -> %s", self.__gazetteer_file, e)
+                return None
+        ix = self.nearest(lat, lon)
+        if ix < 0:
             return ""
+        (name, place_type, state, country) = self.__places[ix]
+        adr = {place_type: name}
+        if state:
+            adr['state'] = state
+        if country:
+            adr['country'] = country
+        return _format_address(adr, self.__key_list)
+
+    def close(self):
+        pass
+
+    def nearest(self, lat, lon):
+        # index of the nearest place within MAX_DISTANCE or -1
+        q = _unit_vectors(np.array([lat]), np.array([lon]))[0]
+        points = self.__points
+        n = len(points)
+        best_d2 = self.__max_chord2
+        best_ix = -1
+        stack = [(0, 0, n, 0.0)]
+        while stack:
+            (node, lo, hi, bound) = stack.pop()
+            if bound >= best_d2: # can't be anything nearer in this part of the tree
+                continue
+            if hi - lo <= OfflineGeoReverse.LEAF_SIZE:
+                d2 = ((points[lo:hi] - q) ** 2).sum(axis=1)
+                i = int(d2.argmin())
+                if d2[i] < best_d2:
+                    best_d2 = float(d2[i])
+                    best_ix = lo + i
+                continue
+            mid = (lo + hi) // 2
+            diff = float(q[self.__split_axis[node]] - self.__split_value[node])
+            near = (2 * node + 1, lo, mid) if diff < 0.0 else (2 * node + 2, mid, hi)
+            far = (2 * node + 2, mid, hi) if diff < 0.0 else (2 * node + 1, lo, mid)
+            stack.append(far + (diff * diff,))
+            stack.append(near + (bound,))
+        return best_ix
+
+    def __load(self):
+        tm = time.time()
+        folder = os.path.dirname(self.__gazetteer_file)
+        admin1 = {}
+        admin1_file = os.path.join(folder, 'admin1CodesASCII.txt')
+        if os.path.isfile(admin1_file):
+            with open(admin1_file, encoding='utf-8', newline='') as f:
+                for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+                    if len(row) > 1:
+                        admin1[row[0]] = row[1]
+        countries = {}
+        country_file = os.path.join(folder, 'countryInfo.txt')
+        if os.path.isfile(country_file):
+            with open(country_file, encoding='utf-8', newline='') as f:
+                for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+                    if len(row) > 4 and not row[0].startswith('#'):
+                        countries[row[0]] = row[4]
+        lats = []
+        lons = []
+        places = []
+        with open(self.__gazetteer_file, encoding='utf-8', newline='') as f:
+            # geonameid, name, asciiname, alternatenames, latitude, longitude, feature class, feature code,
+            # country code, cc2, admin1 code, admin2 code, admin3 code, admin4 code, population, ...
+            for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+                if len(row) < 15 or row[6] != 'P': # only populated places
+                    continue
+                try:
+                    lats.append(float(row[4]))
+                    lons.append(float(row[5]))
+                except ValueError:
+                    continue
+                places.append((row[1], _place_type(row[7], row[14]),
+                               admin1.get(row[8] + '.' + row[10], ''), countries.get(row[8], row[8])))
+        if not places:
+            raise ValueError("no populated places found")
+        points = _unit_vectors(np.array(lats), np.array(lons))
+        (order, self.__split_axis, self.__split_value) = _build_tree(points, OfflineGeoReverse.LEAF_SIZE)
+        self.__points = points[order]
+        self.__places = [places[i] for i in order]
+        self.__logger.info("Loaded %d places from %s in %.1fs", len(places), self.__gazetteer_file, time.time() - tm)
+
+
+def _format_address(adr, key_list):
+    # The address text from a nominatim style address dict. For each part of key_list the first of
+    # its options found in adr is used, or everything in adr if there's no key_list. Some
+    # experimentation might be needed to get a good set of alternatives in key_list
+    adr_list = []
+    if key_list is not None:
+        for part in key_list:
+            for option in part:
+                if option in adr:
+                    adr_list.append(adr[option])
+                    break # add just the first one from the options
+    else:
+        adr_list = adr.values()
+    return ", ".join(adr_list)
+
+def _unit_vectors(lats, lons):
+    lat = np.radians(lats)
+    lon = np.radians(lons)
+    return np.stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)), axis=1).astype(np.float32)
+
+def _place_type(feature_code, population):
+    # nominatim style name for a GeoNames populated place
+    try:
+        population = int(population)
+    except ValueError:
+        population = 0
+    if feature_code == 'PPLX': # section of a populated place
+        return 'suburb'
+    if feature_code in ('PPLC', 'PPLA') or population >= 10000:
+        return 'city'
+    return 'village'
+
+def _build_tree(points, leaf_size):
+    # Returns (order, split_axis, split_value) for an implicit KD-tree of points, i.e. points[order] with
+    # each node covering a range lo:hi split at mid = (lo + hi) // 2 along the axis with the widest spread.
+    # Nodes are numbered as a heap (children of node are 2 * node + 1 and 2 * node + 2)
+    n = len(points)
+    order = np.arange(n)
+    num_nodes = 1
+    while (n + num_nodes - 1) // num_nodes > leaf_size: # i.e. ceil(n / num_nodes) > leaf_size
+        num_nodes *= 2
+    split_axis = np.zeros(2 * num_nodes, dtype=np.uint8)
+    split_value = np.zeros(2 * num_nodes, dtype=np.float32)
+    stack = [(0, 0, n)]
+    while stack:
+        (node, lo, hi) = stack.pop()
+        if hi - lo <= leaf_size:
+            continue
+        sub = points[order[lo:hi]]
+        axis = int((sub.max(axis=0) - sub.min(axis=0)).argmax())
+        mid = (lo + hi) // 2
+        order[lo:hi] = order[lo:hi][np.argpartition(sub[:, axis], mid - lo)]
+        split_axis[node] = axis
+        split_value[node] = points[order[mid], axis]
+        stack.append((2 * node + 1, lo, mid))
+        stack.append((2 * node + 2, mid, hi))
+    return (order, split_axis, split_value)
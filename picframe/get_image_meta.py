@@ -1,17 +1,167 @@
 import exifread
+import io
 import logging
 import os
+import struct
 from PIL import Image
 
+
+# --- header parsers used by GetImageMeta.get_image_size(). Each reads just enough of the
+#     file to find the width and height, or returns None if it can't make sense of it
+def _jpeg_size(fh):
+    if fh.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        b = fh.read(1)
+        while b and b != b'\xff': # skip any junk between segments
+            b = fh.read(1)
+        while b == b'\xff': # and any fill bytes
+            b = fh.read(1)
+        if not b:
+            return None
+        marker = b[0]
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8: # stand alone markers without a length
+            continue
+        if marker in (0xd9, 0xda): # end of image or start of scan before any frame header
+            return None
+        (seg_len,) = struct.unpack('>H', fh.read(2))
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc): # SOFn
+            (_precision, height, width) = struct.unpack('>BHH', fh.read(5))
+            return (width, height)
+        fh.seek(seg_len - 2, 1)
+
+
+def _read_jpeg_header(fh, max_len=1 << 20):
+    # read the leading segments of a jpeg (APP1 EXIF, APP13 IPTC, SOF etc) up to the start of
+    # the compressed data in one bounded, sequential pass. Returns None if not a jpeg
+    data = bytearray(fh.read(2))
+    if data != b'\xff\xd8':
+        return None
+    while len(data) < max_len:
+        hdr = fh.read(4)
+        if len(hdr) < 4 or hdr[0] != 0xff:
+            break
+        data += hdr
+        if hdr[1] in (0xd9, 0xda): # end of image or start of scan
+            break
+        (seg_len,) = struct.unpack('>H', hdr[2:4])
+        data += fh.read(seg_len - 2)
+    return bytes(data)
+
+
+def _png_size(fh):
+    data = fh.read(24)
+    if len(data) < 24 or data[:8] != b'\x89PNG\r\n\x1a\n' or data[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', data[16:24])
+
+
+def _iter_boxes(data, start=0, end=None):
+    # yield (type, content_start, content_end) for the ISO BMFF boxes in data[start:end]
+    end = len(data) if end is None else end
+    while start + 8 <= end:
+        (box_size, box_type) = struct.unpack('>I4s', data[start:start + 8])
+        hdr = 8
+        if box_size == 1:
+            (box_size,) = struct.unpack('>Q', data[start + 8:start + 16])
+            hdr = 16
+        elif box_size == 0:
+            box_size = end - start
+        if box_size < hdr:
+            return
+        yield (box_type, start + hdr, min(start + box_size, end))
+        start += box_size
+
+
+def _heif_size(fh, max_meta=1 << 20):
+    # find the top level meta box without reading the (large) mdat
+    meta = None
+    while meta is None:
+        hdr = fh.read(8)
+        if len(hdr) < 8:
+            return None
+        (box_size, box_type) = struct.unpack('>I4s', hdr)
+        hdr_len = 8
+        if box_size == 1:
+            (box_size,) = struct.unpack('>Q', fh.read(8))
+            hdr_len = 16
+        if box_size < hdr_len:
+            return None
+        if box_type == b'meta':
+            if box_size > max_meta:
+                return None
+            meta = fh.read(box_size - hdr_len)
+        else:
+            fh.seek(box_size - hdr_len, 1)
+    primary = None
+    properties = []
+    associations = {}
+    for (box_type, start, end) in _iter_boxes(meta, 4): # meta is a full box, skip version and flags
+        if box_type == b'pitm':
+            primary = struct.unpack('>H' if meta[start] == 0 else '>I',
+                                    meta[start + 4:start + (6 if meta[start] == 0 else 8)])[0]
+        elif box_type == b'iprp':
+            for (sub_type, sub_start, sub_end) in _iter_boxes(meta, start, end):
+                if sub_type == b'ipco':
+                    properties = list(_iter_boxes(meta, sub_start, sub_end))
+                elif sub_type == b'ipma':
+                    version = meta[sub_start]
+                    flags = int.from_bytes(meta[sub_start + 1:sub_start + 4], 'big')
+                    (count,) = struct.unpack('>I', meta[sub_start + 4:sub_start + 8])
+                    pos = sub_start + 8
+                    for _i in range(count):
+                        if version < 1:
+                            (item_id,) = struct.unpack('>H', meta[pos:pos + 2])
+                            pos += 2
+                        else:
+                            (item_id,) = struct.unpack('>I', meta[pos:pos + 4])
+                            pos += 4
+                        n_assoc = meta[pos]
+                        pos += 1
+                        ix_list = []
+                        for _j in range(n_assoc):
+                            if flags & 1:
+                                ix_list.append(struct.unpack('>H', meta[pos:pos + 2])[0] & 0x7fff)
+                                pos += 2
+                            else:
+                                ix_list.append(meta[pos] & 0x7f)
+                                pos += 1
+                        associations[item_id] = ix_list
+    if primary is None or primary not in associations:
+        return None
+    size = None
+    rotation = 0
+    for ix in associations[primary]: # property indices start at 1, 0 means none
+        if ix < 1 or ix > len(properties):
+            continue
+        (box_type, start, end) = properties[ix - 1]
+        if box_type == b'ispe':
+            size = struct.unpack('>II', meta[start + 4:start + 12]) # after version and flags
+        elif box_type == b'irot':
+            rotation = meta[start] & 0x03
+    if size is not None and rotation in (1, 3): # 90 or 270 degrees
+        size = (size[1], size[0])
+    return size
+
+
 class GetImageMeta:
 
     def __init__(self, filename):
         self.__logger = logging.getLogger("get_image_meta.GetImageMeta")
         self.__tags = {}
         self.__filename = filename # in case no exif data in which case needed for size
+        self.__size = None
+        header = None
         try:
             with open(filename, 'rb') as fh:
-                self.__tags = exifread.process_file(fh, details=False)
+                # for jpegs EXIF, IPTC and size are all taken from a single read of the header
+                header = _read_jpeg_header(fh)
+                if header is not None:
+                    self.__size = _jpeg_size(io.BytesIO(header))
+                    self.__tags = exifread.process_file(io.BytesIO(header), details=False)
+                else:
+                    fh.seek(0)
+                    self.__tags = exifread.process_file(fh, details=False)
         except OSError as e:
             self.__logger.warning("Can't open file: \"%s\"", filename)
             self.__logger.warning("Cause: %s", e)
@@ -19,14 +169,14 @@ class GetImageMeta:
         except Exception as e:
             self.__logger.warning("exifread doesn't manage well and gives AttributeError for heif files %s -> %s",
                                   filename, e)
-        self.__do_iptc_keywords()
+        self.__do_iptc_keywords(header)
 
-    def __do_iptc_keywords(self):
+    def __do_iptc_keywords(self, header=None):
         try:
             from iptcinfo3 import IPTCInfo
             iptcinfo_logger = logging.getLogger('iptcinfo') # turn off useless log infos
             iptcinfo_logger.setLevel(logging.ERROR)
-            with open(self.__filename, 'rb') as fh:
+            with (io.BytesIO(header) if header is not None else open(self.__filename, 'rb')) as fh:
                 iptc = IPTCInfo(fh, force=True, out_charset='utf-8') # TODO put IPTC read in separate function
                 # tags
                 val = iptc['keywords']
@@ -133,14 +283,44 @@ class GetImageMeta:
             return None
 
     def get_size(self):
+        if self.__size is not None: # already found in the jpeg header
+            return self.__size
         try: # corrupt image file might crash app
-            return GetImageMeta.get_image_object(self.__filename).size
+            return GetImageMeta.get_image_size(self.__filename)
         except Exception as e:
             self.__logger.warning("get_size failed on %s -> %s", self.__filename, e)
             return (0, 0)
 
     @staticmethod
-    def get_image_object(fname):
+    def get_image_size(fname):
+        # read the width and height from the file's header, only falling back to PIL
+        # (which will decode heif and heic files) if the header can't be parsed
+        size = None
+        try:
+            with open(fname, 'rb') as fh:
+                head = fh.read(12)
+                fh.seek(0)
+                if head[:2] == b'\xff\xd8':
+                    size = _jpeg_size(fh)
+                elif head[:8] == b'\x89PNG\r\n\x1a\n':
+                    size = _png_size(fh)
+                elif head[4:8] == b'ftyp':
+                    size = _heif_size(fh)
+        except (OSError, struct.error, IndexError) as e:
+            logger = logging.getLogger("get_image_meta.GetImageMeta")
+            logger.debug("Can't read size from header of %s -> %s", fname, e)
+        if size is not None:
+            return tuple(size)
+        ext = os.path.splitext(fname)[1].lower()
+        if ext in ('.heif','.heic'):
+            return GetImageMeta.get_image_object(fname).size
+        with Image.open(fname) as image: # only reads the header, doesn't decode
+            return image.size
+
+    @staticmethod
+    def get_image_object(fname, size=None):
+            # if size (w, h) is given the image is decoded, where the format allows, at the
+            # smallest power of two scale that still covers it i.e. is at least as wide and high
             ext = os.path.splitext(fname)[1].lower()
             if ext in ('.heif','.heic'):
                 try:
@@ -149,6 +329,8 @@ class GetImageMeta:
                     heif_file = pyheif.read(fname)
                     image = Image.frombytes(heif_file.mode, heif_file.size, heif_file.data,
                                             "raw", heif_file.mode, heif_file.stride)
+                    if size is not None:
+                        image = GetImageMeta.reduce_image(image, size)
                     if image.mode not in ("RGB", "RGBA"):
                         image = image.convert("RGB")
                     return image
@@ -158,8 +340,22 @@ class GetImageMeta:
             else:
                 try:
                     image = Image.open(fname)
+                    if size is not None:
+                        if image.format == 'JPEG':
+                            image.draft('RGB', size) # DCT scaling by 1/2, 1/4 or 1/8 while decoding
+                        image = GetImageMeta.reduce_image(image, size)
                     if image.mode not in ("RGB", "RGBA"): # mat system needs RGB or more
                         image = image.convert("RGB")
                 except: # for whatever reason
                     image = None
-                return image
\ No newline at end of file
+                return image
+
+    @staticmethod
+    def reduce_image(image, size):
+        # reduce by the largest power of two that keeps the image covering size
+        factor = min(image.width // max(1, size[0]), image.height // max(1, size[1]))
+        if factor < 2:
+            return image
+        if image.mode not in ("RGB", "RGBA"): # reduce() can't do P, 1 or I;16 and it's converted to RGB after anyway
+            image = image.convert("RGB")
+        return image.reduce(2 ** (factor.bit_length() - 1))
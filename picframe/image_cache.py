@@ -1,13 +1,132 @@
 import sqlite3
 import os
+import sys
+import math
+import pathlib
 import time
 import logging
 import threading
-from picframe import get_image_meta
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from picframe import get_image_meta, dir_watcher, mat_image
+
+def get_exif_info(file_path_name, palette=False):
+    # NB this runs in the scanning process pool so must only use its arguments and return
+    # a plain dict that can be pickled
+    exifs = get_image_meta.GetImageMeta(file_path_name)
+    # Dict to store interesting EXIF data
+    # Note, the 'key' must match a field in the 'meta' table
+    e = {}
+
+    e['orientation'] = exifs.get_orientation()
+
+    width, height = exifs.get_size()
+    ext = os.path.splitext(file_path_name)[1].lower()
+    if ext not in ('.heif','.heic') and e['orientation'] in (5, 6, 7, 8):
+        width, height = height, width # swap values
+    e['width'] = width
+    e['height'] = height
+
+
+    e['f_number'] = exifs.get_exif('EXIF FNumber')
+    e['make'] = exifs.get_exif('Image Make')
+    e['model'] = exifs.get_exif('Image Model')
+    e['exposure_time'] = exifs.get_exif('EXIF ExposureTime')
+    e['iso'] =  exifs.get_exif('EXIF ISOSpeedRatings')
+    e['focal_length'] =  exifs.get_exif('EXIF FocalLength')
+    e['rating'] = exifs.get_exif('Image Rating')
+    e['lens'] = exifs.get_exif('EXIF LensModel')
+    e['exif_datetime'] = None
+    val = exifs.get_exif('EXIF DateTimeOriginal')
+    if val != None:
+        # Remove any subsecond portion of the DateTimeOriginal value. According to the spec, it's
+        # not valid here anyway (should be in SubSecTimeOriginal), but it does exist sometimes.
+        val = val.split('.', 1)[0]
+        try:
+            e['exif_datetime'] = time.mktime(time.strptime(val, '%Y:%m:%d %H:%M:%S'))
+        except:
+            pass
+
+    # If we still don't have a date/time, just use the file's modificaiton time
+    if e['exif_datetime'] == None:
+        e['exif_datetime'] = os.path.getmtime(file_path_name)
+
+    gps = exifs.get_location()
+    lat = gps['latitude']
+    lon = gps['longitude']
+    e['latitude'] = round(lat, 4) if lat is not None else lat #TODO sqlite requires (None,) to insert NULL
+    e['longitude'] = round(lon, 4) if lon is not None else lon
+
+    #IPTC
+    e['tags'] = exifs.get_exif('IPTC Keywords')
+    e['title'] = exifs.get_exif('IPTC Object Name')
+    e['caption'] = exifs.get_exif('IPTC Caption/Abstract')
+
+    # The colors the mat is picked from (only wanted if it's picked automatically), worked out here from
+    # a reduced decode so that it's done once per picture rather than every time it's shown. heif and heic
+    # can only be decoded in full, which costs too much here, so they're left for the display to fill in
+    e['palette'] = None
+    if palette and ext not in ('.heif','.heic'):
+        image = get_image_meta.GetImageMeta.get_image_object(file_path_name,
+                                                             (mat_image.PALETTE_SIZE, mat_image.PALETTE_SIZE))
+        if image is not None:
+            e['palette'] = mat_image.palette_to_text(mat_image.get_palette(image))
+
+    return e
+
+
+def _lower_priority():
+    # initializer for the scanning process pool so that it doesn't compete with the display
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+def _scan_process_main(conn, log_level, log_files, args):
+    # Runs in the scan process started by ImageCache(scan_process=True). All the scanning and geocoding
+    # is done by an ImageCache here, which carries out the messages from the display process sent on conn
+    logging.basicConfig(stream=sys.stdout, level=log_level)
+    for log_file in log_files:
+        filehandler = logging.FileHandler(log_file)
+        filehandler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        logging.getLogger().addHandler(filehandler)
+    _lower_priority()
+    try:
+        cache = ImageCache(*args)
+    except Exception as e:
+        conn.send(('error', str(e)))
+        return
+    conn.send(('ready',))
+    cache.serve(conn)
+
 
 class ImageCache:
 
     EXTENSIONS = ['.png','.jpg','.jpeg','.heif','.heic']
+    BATCH_SIZE = 20 # files read and written to the db at a time
+    COMMIT_FILES = 100 # commit after this many files ...
+    COMMIT_SECONDS = 2.0 # ... or this long, whichever comes first, so new files show up progressively
+    FULL_SCAN_SECONDS = 3600.0 # when using inotify still walk the whole tree this often as a safety net
+    SCAN_MIN_SECONDS = 2.0 # time between passes of update_cache after it has found changes, doubling
+    SCAN_MAX_SECONDS = 600.0 # each time it finds nothing up to this (unless woken by rescan())
+    PAUSE_RUN_SECONDS = 2.0 # a pause longer than its max_seconds lets the scanning threads carry on for this
+                            # long before it holds them again
+    # file records are found via the unique (folder_id, basename, extension) index rather than matching
+    # fname in the all_data view (a full scan). Files are updated in place so they keep their file_id
+    FILE_ID_SQL = """SELECT file_id FROM file WHERE folder_id = (SELECT folder_id FROM folder WHERE name = ?)
+                    AND basename = ? AND extension = ?"""
+    FILE_UPDATE_SQL = """UPDATE file SET last_modified = ? WHERE folder_id = (SELECT folder_id FROM folder WHERE name = ?)
+                    AND basename = ? AND extension = ?"""
+    FILE_INSERT_SQL = """INSERT OR IGNORE INTO file(last_modified, folder_id, basename, extension)
+                    VALUES(?, (SELECT folder_id FROM folder WHERE name = ?), ?, ?)"""
+    DB_CACHE_KIB = 8192 # page cache per connection
+    DB_MMAP_BYTES = 64 * 1024 * 1024 # memory mapped i/o per connection
+    ROW_CACHE_SIZE = 64 # recently read rows kept by get_file_info() and peek_file_info()
+    GEO_BATCH_SIZE = 20 # lat, lon looked up by the geocoding thread between checks for wanted ones
+    GEO_IDLE_SECONDS = 60.0 # how often the geocoding thread checks for new lat, lon when it has nothing to do
+    GEO_RETRY_SECONDS = 60.0 # a failed lookup is tried again after this long, doubling each time ...
+    GEO_RETRY_MAX_SECONDS = 86400.0 # ... up to this
     EXIF_TO_FIELD = {'EXIF FNumber': 'f_number',
                      'Image Make': 'make',
                      'Image Model': 'model',
@@ -22,7 +141,8 @@ class ImageCache:
                      'IPTC Object Name': 'title'}
 
 
-    def __init__(self, picture_dir, follow_links, db_file, geo_reverse, portrait_pairs=False):
+    def __init__(self, picture_dir, follow_links, db_file, geo_reverse, portrait_pairs=False, scan_workers=1,
+                 use_inotify=False, geo_radius=100.0, scan_process=False, palettes=False):
         # TODO these class methods will crash if Model attempts to instantiate this using a
         # different version from the latest one - should this argument be taken out?
         self.__modified_folders = []
@@ -35,46 +155,229 @@ class ImageCache:
         self.__follow_links = follow_links
         self.__db_file = db_file
         self.__geo_reverse = geo_reverse
+        self.__geo_radius = geo_radius # metres within which an already known location is used
         self.__portrait_pairs = portrait_pairs #TODO have a function to turn this on and off?
-        self.__db = self.__create_open_db(self.__db_file)
-        # NB this is where the required schema is set
-        self.__update_schema(3)
+        self.__scan_workers = max(1, int(scan_workers))
+        self.__palettes = palettes # work out the mat palette of each file scanned
+        self.__found_palettes = [] # [palette, file_id] worked out by the display, to be saved
+        self.__found_palettes_lock = threading.Lock()
+        self.__executor = None # process pool for reading exif info, created when first needed
+        self.__upserted_folders = set() # folders already inserted during this pass of update_cache
+        self.__files_since_commit = 0
+        self.__last_commit_tm = time.time()
+        self.__use_inotify = use_inotify
+        self.__watcher = None # created by the first pass of update_cache
+        self.__last_full_scan_tm = 0.0
+        self.__folder_index = None # folder name -> [last_modified, missing] for the folder table and any
+                                   # folders without images, so an unchanged tree needs no SQL at all
+        # The db is in WAL mode. self.__db is the only connection that writes and belongs to the scanning
+        # thread, other threads read through their own read only connection (see __get_reader()) so they
+        # never wait for the scanner's writes or commits. The geocoding thread writes through self.__db
+        # too, holding self.__db_lock, as does the scanner whenever it uses self.__db
+        self.__db_lock = threading.RLock()
+        self.__readers = threading.local()
+        self.__reader_list = []
+        self.__row_cache = OrderedDict() # file_id -> all_data row, least recently used first
+        self.__row_cache_lock = threading.Lock()
+        self.__refresh_files = set() # changed files found by get_file_info() for the scanner to re-read
+        self.__refresh_files_lock = threading.Lock()
+        self.__geo_wanted = set() # (lat, lon) of files about to be shown, looked up before the rest
+        self.__geo_wanted_lock = threading.Lock()
+        self.__geo_wake = threading.Event()
+        self.__geo_thread = None
 
         self.__keep_looping = True
-        self.__pause_looping = False
+        self.__resume = threading.Event() # cleared while the display wants the scanning threads to keep quiet
+        self.__resume.set()
+        self.__pause_tm = 0.0 # time.monotonic() when the current pause started
+        self.__pause_max = None # longest the current pause holds the threads for at a time, see pause_looping()
+        self.__scan_interval = ImageCache.SCAN_MIN_SECONDS
+        self.__scan_wake = threading.Event()
         self.__shutdown_completed = False
         self.__purge_files = False
 
+        # With scan_process the scanning and geocoding threads (and the only connection that writes
+        # to the db) are in a separate process so that they don't compete with the display for the GIL.
+        # This one only reads the db and passes everything else on through self.__scan_conn
+        self.__scan_conn = None
+        self.__scan_conn_lock = threading.Lock()
+        self.__scan_process = None
+        self.__paused = (False, None) # last values sent to the scan process
+        if scan_process:
+            self.__db = None
+            self.__start_scan_process((picture_dir, follow_links, db_file, geo_reverse, portrait_pairs,
+                                       scan_workers, use_inotify, geo_radius, False, palettes))
+            return
+
+        self.__db = self.__create_open_db(self.__db_file)
+        # NB this is where the required schema is set
+        self.__update_schema(6)
+
         t = threading.Thread(target=self.__loop)
         t.start()
+        if self.__geo_reverse is not None:
+            self.__geo_thread = threading.Thread(target=self.__geo_loop, daemon=True)
+            self.__geo_thread.start()
 
 
     def __loop(self):
         while self.__keep_looping:
-            if not self.__pause_looping:
-                self.update_cache()
-                time.sleep(2.0)
-            time.sleep(0.01)
+            self.__wait_while_paused()
+            if self.update_cache():
+                self.__scan_interval = ImageCache.SCAN_MIN_SECONDS
+            elif self.__watcher is None: # an inotify pass only reads its pending events so needn't back off
+                self.__scan_interval = min(self.__scan_interval * 2.0, ImageCache.SCAN_MAX_SECONDS)
+            self.__scan_wake.wait(self.__scan_interval)
+            self.__scan_wake.clear()
         self.__update_file_stats() # write any unsaved file stats before closing
-        self.__db.commit() # close after update_cache finished for last time
-        self.__db.close()
+        if self.__executor is not None:
+            self.__executor.shutdown()
+        if self.__watcher is not None:
+            self.__watcher.close()
+        if self.__geo_thread is not None:
+            self.__geo_wake.set()
+            self.__geo_thread.join()
+        with self.__db_lock:
+            self.__db.commit() # close after update_cache finished for last time
+            self.__db.close()
+            for reader in self.__reader_list:
+                reader.close()
         self.__shutdown_completed = True
 
 
-    def pause_looping(self, value):
-        self.__pause_looping = value
+    def pause_looping(self, value, max_seconds=None):
+        # While value is True (i.e. the display is fading between pictures) the scanning and geocoding
+        # threads stop at their next check in __wait_while_paused(), between reading one file or folder
+        # and the next, and carry on from there when it's set False again. If max_seconds is given they
+        # aren't held for longer than that at a time
+        if self.__scan_conn is not None:
+            if (value, max_seconds) != self.__paused: # this is called every frame
+                self.__paused = (value, max_seconds)
+                self.__send('pause', value, max_seconds)
+            return
+        if value:
+            self.__pause_max = max_seconds
+            if self.__resume.is_set():
+                self.__pause_tm = time.monotonic()
+                self.__resume.clear()
+        else:
+            self.__resume.set()
+
+    def __wait_while_paused(self):
+        # The display can be in transition all the time if time_delay is less than fade_time plus the few
+        # seconds before each change that count as transition too, in which case the pause is given a
+        # max_seconds and holds the threads for no longer than that at a time, or pictures would never be found
+        while not self.__resume.is_set() and self.__keep_looping:
+            paused_for = time.monotonic() - self.__pause_tm
+            pause_max = self.__pause_max
+            if pause_max is not None and paused_for > pause_max:
+                if paused_for < pause_max + ImageCache.PAUSE_RUN_SECONDS:
+                    return
+                self.__pause_tm = time.monotonic() # then hold them again
+            self.__resume.wait(0.1)
 
 
     def stop(self):
+        if self.__scan_conn is not None:
+            self.__send('stop') # blocks until the scan process has shut down
+            self.__scan_process.join()
+            self.__scan_conn.close()
+            for reader in self.__reader_list:
+                reader.close()
+            return
         self.__keep_looping = False
+        self.__scan_wake.set()
         while not self.__shutdown_completed:
             time.sleep(0.05) # make function blocking to ensure staged shutdown
 
     def purge_files(self):
+        if self.__scan_conn is not None:
+            self.__send('purge')
+            return
         self.__purge_files = True
+        self.rescan()
+
+    def rescan(self):
+        # check the whole of pic_dir straight away and go back to scanning often
+        if self.__scan_conn is not None:
+            self.__send('rescan')
+            return
+        self.__last_full_scan_tm = 0.0
+        self.__scan_interval = ImageCache.SCAN_MIN_SECONDS
+        self.__scan_wake.set()
+
+    @property
+    def scan_interval(self):
+        if self.__scan_conn is not None:
+            stats = self.__send('stats')
+            return stats['scan_interval'] if stats is not None else None
+        return self.__scan_interval
+
+    def serve(self, conn):
+        """Carry out the messages sent by the ImageCache in the display process until told to stop,
+        or that process has gone. Only used in the scan process.
+        """
+        while True:
+            try:
+                (cmd, *args) = conn.recv()
+            except (EOFError, OSError):
+                (cmd, args) = ('stop', [])
+            if cmd == 'stop':
+                self.stop()
+                try:
+                    conn.send('stopped')
+                except OSError:
+                    pass
+                return
+            elif cmd == 'pause':
+                self.pause_looping(*args)
+            elif cmd == 'purge':
+                self.purge_files()
+            elif cmd == 'rescan':
+                self.rescan()
+            elif cmd == 'refresh':
+                self.__refresh_file(*args)
+            elif cmd == 'displayed':
+                self.__add_file_to_stats_cache(*args)
+            elif cmd == 'palette':
+                self.set_palette(*args)
+            elif cmd == 'locate':
+                self.__want_location(*args)
+            elif cmd == 'stats':
+                conn.send({'scan_interval': self.__scan_interval, 'files_to_scan': len(self.__modified_files)})
+
+    def __start_scan_process(self, args):
+        ctx = multiprocessing.get_context('spawn')
+        (self.__scan_conn, child_conn) = ctx.Pipe()
+        root_logger = logging.getLogger()
+        log_files = [hdlr.baseFilename for hdlr in root_logger.handlers if isinstance(hdlr, logging.FileHandler)]
+        self.__scan_process = ctx.Process(target=_scan_process_main, name='picframe_scan',
+                                          args=(child_conn, root_logger.level, log_files, args))
+        self.__scan_process.start()
+        child_conn.close()
+        try:
+            reply = self.__scan_conn.recv() # once the db has been created or updated
+        except EOFError:
+            reply = ('error', 'exited with code {}'.format(self.__scan_process.exitcode))
+        if reply[0] != 'ready':
+            self.__scan_process.join()
+            raise RuntimeError("Scan process failed to start: {}".format(reply[1]))
+
+    def __send(self, cmd, *args):
+        # send a message to the scan process, returning its reply for 'stats' and 'stop'
+        with self.__scan_conn_lock:
+            try:
+                self.__scan_conn.send((cmd,) + args)
+                if cmd in ('stats', 'stop'):
+                    return self.__scan_conn.recv()
+            except (EOFError, OSError) as e:
+                self.__logger.error("Scan process not responding to %s -> %s", cmd, e)
+        return None
 
     def update_cache(self):
         """Update the cache database with new and/or modified files
+
+        Returns True if any changes were found
         """
 
         self.__logger.debug('Updating cache')
@@ -82,35 +385,65 @@ class ImageCache:
         # Update any cached file stats. This should be really light-weight
         # so just process any new stats in every pass...
         self.__update_file_stats()
+        self.__update_palettes()
+
+        # Re-read any files that get_file_info() found had changed since they were scanned
+        with self.__refresh_files_lock:
+            refresh_files = sorted(self.__refresh_files)
+            self.__refresh_files.clear()
+        if refresh_files:
+            self.__logger.debug('Refreshing %d changed files', len(refresh_files))
+            self.__modified_files[:0] = refresh_files
 
         # If the current collection of updated files is empty, check for disk-based changes
+        missing_folders = []
         if not self.__modified_files:
             self.__logger.debug('No unprocessed files in memory, checking disk')
-            self.__modified_folders = self.__get_modified_folders()
+            (self.__modified_folders, missing_folders) = self.__get_changed_folders()
             self.__modified_files = self.__get_modified_files(self.__modified_folders)
             self.__logger.debug('Found %d new files on disk', len(self.__modified_files))
-
-        # While we have files to process and looping isn't paused
-        while self.__modified_files and not self.__pause_looping:
-            file = self.__modified_files.pop(0)
-            self.__logger.debug('Inserting: %s', file)
-            self.__insert_file(file)
+        found_changes = bool(refresh_files or self.__modified_folders or self.__modified_files)
+
+        # While we have files to process and we're not stopping
+        # The exif info is read by a process pool (if scan_workers > 1) a batch at a time and
+        # the results written to the db here
+        while self.__modified_files and self.__keep_looping:
+            self.__wait_while_paused()
+            batch = self.__modified_files[:max(ImageCache.BATCH_SIZE, self.__scan_workers * 4)]
+            del self.__modified_files[:len(batch)]
+            file_metas = list(self.__get_exif_info_batch(batch)) # without holding the lock
+            with self.__db_lock:
+                self.__insert_files(file_metas)
+            self.__files_since_commit += len(batch)
+            if (self.__files_since_commit >= ImageCache.COMMIT_FILES
+                    or time.time() - self.__last_commit_tm >= ImageCache.COMMIT_SECONDS):
+                self.__commit()
 
         # If we've process all files in the current collection, update the cached folder info
         if not self.__modified_files:
             self.__update_folder_info(self.__modified_folders)
             self.__modified_folders.clear()
+            self.__upserted_folders.clear()
 
-        # If looping is still not paused, remove any files or folders from the db that are no longer on disk
-        if not self.__pause_looping:
-            self.__purge_missing_files_and_folders()
+        # Remove any files or folders from the db that are no longer on disk
+        if missing_folders is None or missing_folders or self.__purge_files:
+            self.__wait_while_paused()
+            # a purge checks every folder in the db, the flagged ones too, whatever kind of pass this was
+            self.__purge_missing_files_and_folders(None if self.__purge_files else missing_folders)
 
         # Commit the current set of changes
-        self.__db.commit()
+        self.__commit()
+        return found_changes
+
+    def __commit(self):
+        with self.__db_lock:
+            self.__db.commit()
+        self.__files_since_commit = 0
+        self.__last_commit_tm = time.time()
 
 
     def query_cache(self, where_clause, sort_clause = 'fname ASC'):
-        cursor = self.__db.cursor()
+        cursor = self.__get_reader().cursor()
         cursor.row_factory = None # we don't want the "sqlite3.Row" setting from the db here...
         try:
             if not self.__portrait_pairs: # TODO SQL insertion? Does it matter in this app?
@@ -153,51 +486,248 @@ class ImageCache:
 
     def get_file_info(self, file_id):
         if not file_id: return None
-        sql = "SELECT * FROM all_data where file_id = {0}".format(file_id)
-        row = self.__db.execute(sql).fetchone()
+        row = self.__get_row(file_id)
         try:
-            if row is not None and row['last_modified']  != os.path.getmtime(row['fname']):
-                self.__logger.debug('Cache miss: File %s changed on disk', row['fname'])
-                self.__insert_file(row['fname'], file_id)
-                row = self.__db.execute(sql).fetchone() # description inserted in table
+            if row is not None and row['last_modified'] != os.path.getmtime(row['fname']):
+                self.__forget_row(file_id) # maybe a stale cached row, check the db again
+                row = self.__get_row(file_id)
+                if row is not None and row['last_modified'] != os.path.getmtime(row['fname']):
+                    # show what's in the db this time and let the scanner re-read the file
+                    self.__logger.debug('Cache miss: File %s changed on disk', row['fname'])
+                    self.__forget_row(file_id)
+                    self.__refresh_file(row['fname'])
         except OSError:
             self.__logger.warning("Image '%s' does not exists or is inaccessible" %row['fname'])
-        if row is not None and row['latitude'] is not None and row['longitude'] is not None and row['location'] is None:
-            if self.__get_geo_location(row['latitude'], row['longitude']):
-                row = self.__db.execute(sql).fetchone() # description inserted in table
         self.__add_file_to_stats_cache(file_id) # Add a record to the file stats cache collection
         return row # NB if select fails (i.e. moved file) will return None
 
+    def peek_file_info(self, file_id):
+        # as get_file_info() but without checking the file on disk or counting it as displayed
+        if not file_id: return None
+        return self.__get_row(file_id)
+
+    def __get_row(self, file_id):
+        # all_data row for file_id from the LRU cache or the db. Rows still waiting for their
+        # location to be looked up aren't cached so that it shows up once it has been. Ones with a
+        # location row are, even if it had no address (NULL description)
+        with self.__row_cache_lock:
+            row = self.__row_cache.get(file_id)
+            if row is not None:
+                self.__row_cache.move_to_end(file_id)
+                return row
+        sql = "SELECT * FROM all_data where file_id = {0}".format(file_id)
+        reader = self.__get_reader()
+        row = reader.execute(sql).fetchone()
+        if row is not None and (row['latitude'] is None or row['longitude'] is None or row['location'] is not None
+                                or reader.execute("SELECT 1 FROM location WHERE latitude = ? AND longitude = ?",
+                                                  (row['latitude'], row['longitude'])).fetchone() is not None):
+            with self.__row_cache_lock:
+                self.__row_cache[file_id] = row
+                if len(self.__row_cache) > ImageCache.ROW_CACHE_SIZE:
+                    self.__row_cache.popitem(last=False)
+        elif row is not None and self.__geo_reverse is not None: # ask for its location to be looked up next
+            self.__want_location(row['latitude'], row['longitude'])
+        return row
+
+    def __refresh_file(self, fname):
+        if self.__scan_conn is not None:
+            self.__send('refresh', fname)
+            return
+        with self.__refresh_files_lock:
+            self.__refresh_files.add(fname)
+        self.__scan_wake.set()
+
+    def __want_location(self, lat, lon):
+        if self.__scan_conn is not None:
+            self.__send('locate', lat, lon)
+            return
+        with self.__geo_wanted_lock:
+            self.__geo_wanted.add((lat, lon))
+        self.__geo_wake.set()
+
+    def __forget_row(self, file_id):
+        with self.__row_cache_lock:
+            self.__row_cache.pop(file_id, None)
+
     def get_column_names(self):
         sql = "PRAGMA table_info(all_data)"
-        rows = self.__db.execute(sql).fetchall()
+        rows = self.__get_reader().execute(sql).fetchall()
         return [row['name'] for row in rows]
 
-    def __add_file_to_stats_cache(self, file_id):
+    def __get_reader(self):
+        # read only connection for the calling thread, opened the first time it's needed
+        reader = getattr(self.__readers, 'db', None)
+        if reader is None:
+            uri = pathlib.Path(os.path.abspath(self.__db_file)).as_uri() + '?mode=ro'
+            # check_same_thread=False only so that they can all be closed by the scanning thread
+            reader = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            reader.row_factory = sqlite3.Row
+            self.__set_pragmas(reader)
+            self.__readers.db = reader
+            with self.__db_lock:
+                self.__reader_list.append(reader)
+        return reader
+
+    def __set_pragmas(self, db):
+        db.execute('PRAGMA cache_size = -{}'.format(ImageCache.DB_CACHE_KIB))
+        db.execute('PRAGMA mmap_size = {}'.format(ImageCache.DB_MMAP_BYTES))
+
+    def __add_file_to_stats_cache(self, file_id, displayed_tm=None):
+        if displayed_tm is None:
+            displayed_tm = time.time()
+        if self.__scan_conn is not None:
+            self.__send('displayed', file_id, displayed_tm)
+            return
         # This collection is shared between threads, so lock it to update
         self.__cached_file_stats_lock.acquire()
-        self.__cached_file_stats.append([file_id, time.time()])
+        self.__cached_file_stats.append([file_id, displayed_tm])
         self.__cached_file_stats_lock.release()
 
+    def set_palette(self, file_id, palette):
+        # Save the mat palette text the display had to work out for a file that didn't have one (i.e. heic,
+        # files scanned before there were palettes, or while the mat color was set)
+        self.__forget_row(file_id)
+        if self.__scan_conn is not None:
+            self.__send('palette', file_id, palette)
+            return
+        with self.__found_palettes_lock:
+            self.__found_palettes.append([palette, file_id])
+
+    def __update_palettes(self):
+        with self.__found_palettes_lock:
+            (found_palettes, self.__found_palettes) = (self.__found_palettes, [])
+        if found_palettes:
+            with self.__db_lock:
+                self.__db.executemany("UPDATE meta SET palette = ? WHERE file_id = ?", found_palettes)
+                self.__db.commit()
+            for (_palette, file_id) in found_palettes: # in case one was read again before it was saved
+                self.__forget_row(file_id)
+
     def __update_file_stats(self):
         # Process (and drain) the entire collection of cached file stats by storing them in the db
         # Note, this is likely an empty or very small collection
         if self.__cached_file_stats:
             sql = "UPDATE file SET displayed_count = displayed_count + 1, last_displayed = ? WHERE file_id = ?"
             self.__cached_file_stats_lock.acquire()
-            while self.__cached_file_stats:
-                file_id, timestamp = self.__cached_file_stats.pop()
-                self.__db.execute(sql, (timestamp, file_id))
+            with self.__db_lock:
+                while self.__cached_file_stats:
+                    file_id, timestamp = self.__cached_file_stats.pop()
+                    self.__db.execute(sql, (timestamp, file_id))
             self.__cached_file_stats_lock.release()
 
-    def __get_geo_location(self, lat, lon): # TODO periodically check all lat/lon in meta with no location and try again
-        location = self.__geo_reverse.get_address(lat, lon)
-        if len(location) == 0:
-            return False #TODO this will continue to try even if there is some permanant cause
+    def __geo_loop(self):
+        # Looks up the location of every lat, lon in the meta table without one, those of files about to
+        # be shown first, so that the slideshow never waits for the network. Failed lookups are recorded
+        # in the location_retry table and not tried again until their (increasing) delay has passed. If
+        # lookups keep failing (no network) the whole thread backs off in the same way
+        failures = 0
+        while self.__keep_looping:
+            self.__wait_while_paused()
+            coords = self.__get_geo_backlog()
+            if not coords:
+                self.__geo_wake.wait(ImageCache.GEO_IDLE_SECONDS)
+                self.__geo_wake.clear()
+                continue
+            for (lat, lon) in coords:
+                self.__wait_while_paused()
+                if not self.__keep_looping:
+                    break
+                location = self.__get_nearby_location(lat, lon)
+                nearby = location is not None # saves asking again for every picture taken in the same place
+                if not nearby:
+                    location = self.__geo_reverse.get_address(lat, lon) # rate limited by geo_reverse
+                self.__save_geo_location(lat, lon, location, nearby)
+                if location is None:
+                    failures += 1
+                    retry_tm = time.time() + self.__geo_retry_delay(failures)
+                    while self.__keep_looping and time.time() < retry_tm:
+                        self.__geo_wake.wait(retry_tm - time.time())
+                        self.__geo_wake.clear()
+                    break
+                failures = 0
+        self.__geo_reverse.close()
+
+    def __get_geo_backlog(self):
+        # lat, lon that need looking up, wanted ones first, skipping any waiting to be retried
+        now = time.time()
+        reader = self.__get_reader()
+        with self.__geo_wanted_lock:
+            wanted = list(self.__geo_wanted)
+            self.__geo_wanted.clear()
+        sql_due = """
+            SELECT NOT EXISTS(SELECT 1 FROM location WHERE latitude = :lat AND longitude = :lon)
+                AND NOT EXISTS(SELECT 1 FROM location_retry WHERE latitude = :lat AND longitude = :lon
+                    AND next_try > :now)
+            """
+        coords = [(lat, lon) for (lat, lon) in wanted
+                    if reader.execute(sql_due, {'lat': lat, 'lon': lon, 'now': now}).fetchone()[0]]
+        if coords:
+            return coords
+        sql = """
+            SELECT DISTINCT meta.latitude, meta.longitude
+            FROM meta
+                LEFT JOIN location
+                    ON location.latitude = meta.latitude AND location.longitude = meta.longitude
+                LEFT JOIN location_retry
+                    ON location_retry.latitude = meta.latitude AND location_retry.longitude = meta.longitude
+            WHERE meta.latitude IS NOT NULL AND meta.longitude IS NOT NULL AND location.id IS NULL
+                AND (location_retry.next_try IS NULL OR location_retry.next_try <= ?)
+            LIMIT ?
+            """
+        return [tuple(row) for row in reader.execute(sql, (now, ImageCache.GEO_BATCH_SIZE))]
+
+    def __get_nearby_location(self, lat, lon):
+        # Description (or "" if it had no address) of the nearest location already looked up within
+        # geo_radius metres of lat, lon, or None. The location table's unique (latitude, longitude) index
+        # narrows the search to a thin band of latitude, which is then filtered to the bounding box (in two
+        # parts if it crosses the antimeridian) and the nearest chosen using an equirectangular
+        # approximation (fine over such short distances)
+        if self.__geo_radius <= 0:
+            return None
+        d_lat = self.__geo_radius / 111320.0 # metres per degree of latitude
+        cos_lat = max(math.cos(math.radians(lat)), 0.01)
+        d_lon = d_lat / cos_lat
+        if d_lon >= 180.0: # at the poles
+            lon_ranges = (-180.0, 180.0) * 2
+        elif lon - d_lon < -180.0:
+            lon_ranges = (lon - d_lon + 360.0, 180.0, -180.0, lon + d_lon)
+        elif lon + d_lon > 180.0:
+            lon_ranges = (lon - d_lon, 180.0, -180.0, lon + d_lon - 360.0)
         else:
-            sql = "INSERT OR REPLACE INTO location (latitude, longitude, description) VALUES (?, ?, ?)"
-            self.__db.execute(sql, (lat, lon, location))
-            return True
+            lon_ranges = (lon - d_lon, lon + d_lon) * 2
+        sql = """
+            SELECT latitude, longitude, description FROM location
+            WHERE latitude BETWEEN ? AND ? AND (longitude BETWEEN ? AND ? OR longitude BETWEEN ? AND ?)
+                AND nearby = 0
+            """
+        nearest = None
+        for row in self.__get_reader().execute(sql, (lat - d_lat, lat + d_lat) + lon_ranges):
+            dist = math.hypot(row['latitude'] - lat,
+                              ((row['longitude'] - lon + 180.0) % 360.0 - 180.0) * cos_lat) * 111320.0
+            if dist <= self.__geo_radius and (nearest is None or dist < nearest[0]):
+                nearest = (dist, row['description'] or "")
+        return nearest[1] if nearest is not None else None
+
+    def __geo_retry_delay(self, attempts):
+        return min(ImageCache.GEO_RETRY_MAX_SECONDS, ImageCache.GEO_RETRY_SECONDS * 2 ** min(attempts - 1, 20))
+
+    def __save_geo_location(self, lat, lon, location, nearby=False):
+        # location is the text from geo_reverse.get_address(), "" if there's no address at lat, lon, which
+        # is stored as NULL so that it isn't shown or looked up again, or None if the lookup failed. nearby
+        # is True if it was copied from a nearby location
+        with self.__db_lock:
+            if location is None:
+                self.__db.execute("INSERT OR IGNORE INTO location_retry (latitude, longitude) VALUES (?, ?)", (lat, lon))
+                self.__db.execute("""UPDATE location_retry SET attempts = attempts + 1,
+                        next_try = :now + MIN(:max_delay, :delay * (1 << MIN(attempts, 20)))
+                    WHERE latitude = :lat AND longitude = :lon""",
+                    {'now': time.time(), 'max_delay': ImageCache.GEO_RETRY_MAX_SECONDS,
+                     'delay': ImageCache.GEO_RETRY_SECONDS, 'lat': lat, 'lon': lon})
+            else:
+                sql = "INSERT OR REPLACE INTO location (latitude, longitude, description, nearby) VALUES (?, ?, ?, ?)"
+                self.__db.execute(sql, (lat, lon, location if location else None, int(nearby)))
+                self.__db.execute("DELETE FROM location_retry WHERE latitude = ? AND longitude = ?", (lat, lon))
+            self.__db.commit() # so that it can be read straight away
 
 
     def __create_open_db(self, db_file):
@@ -252,6 +782,16 @@ class ImageCache:
                 UNIQUE (latitude, longitude)
             )"""
 
+        # lat, lon whose lookup by the geocoding thread failed and when to try again
+        sql_location_retry_table = """
+            CREATE TABLE IF NOT EXISTS location_retry (
+                latitude REAL,
+                longitude REAL,
+                attempts INTEGER DEFAULT 0 NOT NULL,
+                next_try REAL DEFAULT 0 NOT NULL,
+                UNIQUE (latitude, longitude)
+            )"""
+
         sql_db_info_table = """
             CREATE TABLE IF NOT EXISTS db_info (
                 schema_version INTEGER NOT NULL
@@ -296,10 +836,13 @@ class ImageCache:
                 DELETE FROM meta WHERE file_id = OLD.file_id;
             END"""
 
-        db = sqlite3.connect(db_file, check_same_thread=False) # writing only done in loop thread, reading in this so should be safe
+        db = sqlite3.connect(db_file, check_same_thread=False) # NB shared with other threads via self.__db_lock
         db.row_factory = sqlite3.Row # make results accessible by field name
-        for item in (sql_folder_table, sql_file_table, sql_meta_table, sql_location_table, sql_meta_index,
-                    sql_all_data_view, sql_db_info_table, sql_clean_file_trigger, sql_clean_meta_trigger):
+        db.execute('PRAGMA journal_mode = WAL') # readers and the writer don't block each other
+        db.execute('PRAGMA synchronous = NORMAL') # safe with WAL, only the last commits can be lost on power cut
+        self.__set_pragmas(db)
+        for item in (sql_folder_table, sql_file_table, sql_meta_table, sql_location_table, sql_location_retry_table,
+                    sql_meta_index, sql_all_data_view, sql_db_info_table, sql_clean_file_trigger, sql_clean_meta_trigger):
             db.execute(item)
 
         return db
@@ -349,173 +892,261 @@ class ImageCache:
                 self.__db.execute("ALTER TABLE file ADD COLUMN displayed_count INTEGER default 0 NOT NULL")
                 self.__db.execute("ALTER TABLE file ADD COLUMN last_displayed REAL DEFAULT 0 NOT NULL")
 
+            if schema_version <= 3:
+                # Migrate to db schema v4
+                # Files are now updated in place rather than with INSERT OR REPLACE, which gave a changed
+                # file a new file_id without firing Clean_Meta_Trigger for the old one. Remove the meta
+                # records that were orphaned that way.
+                self.__db.execute("DELETE FROM meta WHERE file_id NOT IN (SELECT file_id FROM file)")
+
+            if schema_version <= 4:
+                # Migrate to db schema v5
+                # Flag locations copied from a nearby one rather than looked up, so that only those that
+                # were looked up are copied (otherwise a long walk could be given its starting point)
+                self.__db.execute("ALTER TABLE location ADD COLUMN nearby INTEGER DEFAULT 0 NOT NULL")
+
+            if schema_version <= 5:
+                # Migrate to db schema v6
+                # Add the palette of colors the mat is picked from. It's filled in as files are scanned
+                # or, for those already in the db, by the display the first time each is matted
+                self.__db.execute("ALTER TABLE meta ADD COLUMN palette TEXT")
+
             # Finally, update the db's schema version stamp to the app's requested version
             self.__db.execute('DELETE FROM db_info')
             self.__db.execute('INSERT INTO db_info VALUES(?)', (required_db_schema_version,))
             self.__db.commit()
 
+    def __get_changed_folders(self):
+        # Returns (modified folders, missing folders). With inotify only the folders it has seen change
+        # are checked, and the whole tree is only walked at start, when events were lost or every
+        # FULL_SCAN_SECONDS. Otherwise (or if inotify can't be used) every pass walks the whole tree.
+        # Missing folders are the known folders the walk didn't come across, or None if inotify saw
+        # something removed and every folder in the db has to be checked
+        if self.__use_inotify and self.__watcher is None:
+            try: # created before the first full walk so no changes can be missed
+                self.__watcher = dir_watcher.InotifyWatcher(self.__picture_dir, self.__follow_links)
+            except (OSError, AttributeError) as e:
+                self.__logger.warning("Can't use inotify, falling back to polling %s -> %s", self.__picture_dir, e)
+                self.__use_inotify = False
+        if self.__watcher is not None:
+            (changed, removed, overflow) = self.__watcher.get_changed_folders()
+            if not overflow and time.time() - self.__last_full_scan_tm < ImageCache.FULL_SCAN_SECONDS:
+                modified_folders = []
+                for dir in sorted(changed):
+                    try:
+                        modified_folders.append((dir, int(os.stat(dir).st_mtime)))
+                    except OSError: # gone again
+                        removed = True
+                return (modified_folders, None if removed else [])
+            self.__last_full_scan_tm = time.time()
+        return self.__get_modified_folders()
+
     # --- Returns a set of folders matching any of
     #     - Found on disk, but not currently in the 'folder' table
     #     - Found on disk, but newer than the associated record in the 'folder' table
     #     - Found on disk, but flagged as 'missing' in the 'folder' table
     # --- Note that all folders returned currently exist on disk
+    # --- Also returns the folders in the index that weren't walked, i.e. have probably gone
     def __get_modified_folders(self):
         out_of_date_folders = []
-        sql_select = "SELECT * FROM folder WHERE name = ?"
-        for dir in [d[0] for d in os.walk(self.__picture_dir, followlinks=self.__follow_links)]:
-            if os.path.basename(dir)[0] == '.': continue # ignore hidden folders
-            mod_tm = int(os.stat(dir).st_mtime)
-            found = self.__db.execute(sql_select, (dir,)).fetchone()
-            if not found or found['last_modified'] < mod_tm or found['missing'] == 1:
+        walked_folders = set()
+        folder_index = self.__get_folder_index()
+        for (dir, mod_tm) in self.__walk_folders():
+            walked_folders.add(dir)
+            found = folder_index.get(dir)
+            if not found or found[0] < mod_tm or found[1] == 1:
                 out_of_date_folders.append((dir, mod_tm))
-        return out_of_date_folders
-
+        return (out_of_date_folders, [name for name in folder_index if name not in walked_folders])
 
+    def __walk_folders(self):
+        # Generator of (folder, int mtime) for pic_dir and every folder below it using os.scandir so
+        # that each folder is only stat'ed once. Hidden folders (including .AppleDouble) are pruned
+        # before descending into them and, if following links, each real folder is only visited once
+        try:
+            root_stat = os.stat(self.__picture_dir)
+        except OSError as e:
+            self.__logger.warning("Can't read picture folder %s -> %s", self.__picture_dir, e)
+            return
+        visited = set()
+        stack = [(self.__picture_dir, root_stat)]
+        while stack:
+            (dir, dir_stat) = stack.pop()
+            if self.__follow_links:
+                if (dir_stat.st_dev, dir_stat.st_ino) in visited: # symlink cycle
+                    continue
+                visited.add((dir_stat.st_dev, dir_stat.st_ino))
+            self.__wait_while_paused()
+            yield (dir, int(dir_stat.st_mtime))
+            sub_dirs = []
+            try:
+                with os.scandir(dir) as entries:
+                    for entry in entries:
+                        if entry.name.startswith('.'):
+                            continue
+                        try:
+                            if entry.is_dir(follow_symlinks=self.__follow_links):
+                                sub_dirs.append((entry.path, entry.stat(follow_symlinks=self.__follow_links)))
+                        except OSError: # i.e. broken link or removed while walking
+                            continue
+            except OSError as e:
+                self.__logger.warning("Can't read folder %s -> %s", dir, e)
+            stack.extend(sorted(sub_dirs, reverse=True)) # so popped in name order
+
+    def __get_folder_index(self):
+        # load the folder table once, after which it's kept in step with every change written to it
+        # by the scanner
+        if self.__folder_index is None:
+            with self.__db_lock:
+                self.__folder_index = {row['name']: [row['last_modified'], row['missing']]
+                                       for row in self.__db.execute('SELECT name, last_modified, missing FROM folder')}
+        return self.__folder_index
+
+
+    # --- Returns the image files in modified_folders that aren't in the 'file' table or are newer
+    #     than their record. Each folder's records are loaded with a single query and compared
+    #     with one listing of the folder, which also finds (and deletes) records of files that
+    #     have gone from it
     def __get_modified_files(self, modified_folders):
         out_of_date_files = []
-        #sql_select = "SELECT fname, last_modified FROM all_data WHERE fname = ? and last_modified >= ?"
+        deleted_file_ids = []
         sql_select = """
-        SELECT file.basename, file.last_modified
+        SELECT file.file_id, file.basename, file.extension, file.last_modified
             FROM file
                 INNER JOIN folder
                     ON folder.folder_id = file.folder_id
-            WHERE file.basename = ? AND file.extension = ? AND folder.name = ? AND file.last_modified >= ?
+            WHERE folder.name = ?
         """
         for dir,_date in modified_folders:
-            for file in os.listdir(dir):
-                base, extension = os.path.splitext(file)
-                if (extension.lower() in ImageCache.EXTENSIONS
-                        and not '.AppleDouble' in dir and not file.startswith('.')): # have to filter out all the Apple junk
-                    full_file = os.path.join(dir, file)
-                    mod_tm =  os.path.getmtime(full_file)
-                    found = self.__db.execute(sql_select, (base, extension.lstrip("."), dir, mod_tm)).fetchone()
-                    if not found:
-                        out_of_date_files.append(full_file)
+            self.__wait_while_paused()
+            if '.AppleDouble' in dir: # have to filter out all the Apple junk
+                continue
+            with self.__db_lock:
+                db_files = {(row['basename'], row['extension']): (row['file_id'], row['last_modified'])
+                            for row in self.__db.execute(sql_select, (dir,))}
+            try:
+                with os.scandir(dir) as entries:
+                    for entry in entries:
+                        base, extension = os.path.splitext(entry.name)
+                        if (extension.lower() not in ImageCache.EXTENSIONS or entry.name.startswith('.')
+                                or not entry.is_file()):
+                            continue
+                        found = db_files.pop((base, extension.lstrip(".")), None)
+                        if found is None or found[1] < entry.stat().st_mtime:
+                            out_of_date_files.append(entry.path)
+            except OSError as e: # folder removed since it was found, leave it for the purge
+                self.__logger.warning("Can't read folder %s -> %s", dir, e)
+                continue
+            deleted_file_ids.extend([file_id] for (file_id, _mod_tm) in db_files.values())
+        # Note, this will automatically remove matching records from the 'meta' table as well.
+        if deleted_file_ids:
+            self.__logger.debug('Deleting %d files no longer on disk', len(deleted_file_ids))
+            with self.__db_lock:
+                self.__db.executemany('DELETE FROM file WHERE file_id = ?', deleted_file_ids)
         return out_of_date_files
 
 
-    def __insert_file(self, file, file_id = None):
-        file_insert = "INSERT OR REPLACE INTO file(folder_id, basename, extension, last_modified) VALUES((SELECT folder_id from folder where name = ?), ?, ?, ?)"
-        file_update = "UPDATE file SET folder_id = (SELECT folder_id from folder where name = ?), basename = ?, extension = ?, last_modified = ? WHERE file_id = ?"
-        # Insert the new folder if it's not already in the table. Update the missing field separately.
+    def __get_exif_info_batch(self, files):
+        # generator of (file, meta) for each file that could be read, in the same order
+        if self.__scan_workers < 2:
+            for file in files:
+                self.__wait_while_paused()
+                try:
+                    yield (file, get_exif_info(file, self.__palettes))
+                except Exception as e:
+                    self.__logger.warning("Can't read exif info from %s -> %s", file, e)
+            return
+        if self.__executor is None:
+            self.__executor = ProcessPoolExecutor(max_workers=self.__scan_workers,
+                                                  mp_context=multiprocessing.get_context('spawn'),
+                                                  initializer=_lower_priority)
+        futures = [self.__executor.submit(get_exif_info, file, self.__palettes) for file in files]
+        for (file, future) in zip(files, futures):
+            try:
+                yield (file, future.result())
+            except Exception as e:
+                self.__logger.warning("Can't read exif info from %s -> %s", file, e)
+
+    def __insert_files(self, file_metas):
+        # Insert a batch of (file, meta) into the folder, file and meta tables with one executemany
+        # per table. Each folder is only inserted once per pass of update_cache
         folder_insert = "INSERT OR IGNORE INTO folder(name) VALUES(?)"
         folder_update = "UPDATE folder SET missing = 0 where name = ?"
 
-        mod_tm =  os.path.getmtime(file)
-        dir, file_only = os.path.split(file)
-        base, extension = os.path.splitext(file_only)
-
-        # Get the file's meta info and build the INSERT statement dynamically
-        meta = self.__get_exif_info(file)
-        meta_insert = self.__get_meta_sql_from_dict(meta)
-        vals = list(meta.values())
-        vals.insert(0, file)
-
-        # Insert this file's info into the folder, file, and meta tables
-        self.__db.execute(folder_insert, (dir,))
-        self.__db.execute(folder_update, (dir,))
-        if file_id is None:
-            self.__db.execute(file_insert, (dir, base, extension.lstrip("."), mod_tm))
-        else:
-            self.__db.execute(file_update, (dir, base, extension.lstrip("."), mod_tm, file_id))
-        self.__db.execute(meta_insert, vals)
-
+        folder_vals = []
+        file_vals = []
+        meta_vals = []
+        meta_insert = None
+        for (file, meta) in file_metas:
+            try:
+                mod_tm = os.path.getmtime(file)
+            except OSError:
+                self.__logger.warning("Image '%s' does not exists or is inaccessible", file)
+                continue
+            self.__logger.debug('Inserting: %s', file)
+            dir, file_only = os.path.split(file)
+            base, extension = os.path.splitext(file_only)
+            if dir not in self.__upserted_folders:
+                self.__upserted_folders.add(dir)
+                folder_vals.append((dir,))
+                self.__get_folder_index().setdefault(dir, [0, 0])[1] = 0
+            file_vals.append((mod_tm, dir, base, extension.lstrip(".")))
+            if meta_insert is None: # get_exif_info() always returns the same keys
+                meta_insert = self.__get_meta_sql_from_dict(meta)
+            meta_vals.append([dir, base, extension.lstrip(".")] + list(meta.values()))
+
+        if file_vals:
+            self.__db.executemany(folder_insert, folder_vals)
+            self.__db.executemany(folder_update, folder_vals)
+            self.__db.executemany(ImageCache.FILE_UPDATE_SQL, file_vals)
+            self.__db.executemany(ImageCache.FILE_INSERT_SQL, file_vals)
+            self.__db.executemany(meta_insert, meta_vals)
 
     def __update_folder_info(self, folder_collection):
         update_data = []
         sql = "UPDATE folder SET last_modified = ?, missing = 0 WHERE name = ?"
+        folder_index = self.__get_folder_index()
         for folder, modtime in folder_collection:
             update_data.append((modtime, folder))
-        self.__db.executemany(sql, update_data)
+            folder_index[folder] = [modtime, 0] # also remember folders without images (and no row)
+        with self.__db_lock:
+            self.__db.executemany(sql, update_data)
 
 
     def __get_meta_sql_from_dict(self, dict):
         columns = ', '.join(dict.keys())
         ques = ', '.join('?' * len(dict.keys()))
-        return 'INSERT OR REPLACE INTO meta(file_id, {0}) VALUES((SELECT file_id from all_data where fname = ?), {1})'.format(columns, ques)
+        return 'INSERT OR REPLACE INTO meta(file_id, {0}) VALUES(({1}), {2})'.format(columns, ImageCache.FILE_ID_SQL, ques)
 
 
-    def __purge_missing_files_and_folders(self):
-        # Find folders in the db that are no longer on disk
-        folder_id_list = []
-        for row in self.__db.execute('SELECT folder_id, name from folder'):
-            if not os.path.exists(row['name']):
-                folder_id_list.append([row['folder_id']])
+    def __purge_missing_files_and_folders(self, folder_names=None):
+        # Find which of folder_names (all the folders in the db if None) are no longer on disk. Ones the
+        # walk didn't reach are checked again as it skips any folder it can't read
+        folder_index = self.__get_folder_index()
+        if folder_names is None:
+            with self.__db_lock:
+                folder_names = [row['name'] for row in self.__db.execute('SELECT name from folder')]
+        if not self.__purge_files: # no need to flag them again
+            folder_names = [name for name in folder_names if name not in folder_index or folder_index[name][1] != 1]
+        folder_names = [name for name in folder_names if not os.path.exists(name)]
 
         # Flag or delete any non-existent folders from the db. Note, deleting will automatically
         # remove orphaned records from the 'file' and 'meta' tables
-        if len(folder_id_list):
+        if len(folder_names):
             if self.__purge_files:
-                self.__db.executemany('DELETE FROM folder WHERE folder_id = ?', folder_id_list)
+                with self.__db_lock:
+                    self.__db.executemany('DELETE FROM folder WHERE name = ?', [[name] for name in folder_names])
+                for name in folder_names:
+                    folder_index.pop(name, None)
             else:
-                self.__db.executemany('UPDATE folder SET missing = 1 WHERE folder_id = ?', folder_id_list)
-
-        # Find files in the db that are no longer on disk
-        if self.__purge_files:
-            file_id_list = []
-            for row in self.__db.execute('SELECT file_id, fname from all_data'):
-                if not os.path.exists(row['fname']):
-                    file_id_list.append([row['file_id']])
-
-            # Delete any non-existent files from the db. Note, this will automatically
-            # remove matching records from the 'meta' table as well.
-            if len(file_id_list):
-                self.__db.executemany('DELETE FROM file WHERE file_id = ?', file_id_list)
-            self.__purge_files = False
-
-    def __get_exif_info(self, file_path_name):
-        exifs = get_image_meta.GetImageMeta(file_path_name)
-        # Dict to store interesting EXIF data
-        # Note, the 'key' must match a field in the 'meta' table
-        e = {}
-
-        e['orientation'] = exifs.get_orientation()
-
-        width, height = exifs.get_size()
-        ext = os.path.splitext(file_path_name)[1].lower()
-        if ext not in ('.heif','.heic') and e['orientation'] in (5, 6, 7, 8):
-            width, height = height, width # swap values
-        e['width'] = width
-        e['height'] = height
-
-
-        e['f_number'] = exifs.get_exif('EXIF FNumber')
-        e['make'] = exifs.get_exif('Image Make')
-        e['model'] = exifs.get_exif('Image Model')
-        e['exposure_time'] = exifs.get_exif('EXIF ExposureTime')
-        e['iso'] =  exifs.get_exif('EXIF ISOSpeedRatings')
-        e['focal_length'] =  exifs.get_exif('EXIF FocalLength')
-        e['rating'] = exifs.get_exif('Image Rating')
-        e['lens'] = exifs.get_exif('EXIF LensModel')
-        e['exif_datetime'] = None
-        val = exifs.get_exif('EXIF DateTimeOriginal')
-        if val != None:
-            # Remove any subsecond portion of the DateTimeOriginal value. According to the spec, it's
-            # not valid here anyway (should be in SubSecTimeOriginal), but it does exist sometimes.
-            val = val.split('.', 1)[0]
-            try:
-                e['exif_datetime'] = time.mktime(time.strptime(val, '%Y:%m:%d %H:%M:%S'))
-            except:
-                pass
-
-        # If we still don't have a date/time, just use the file's modificaiton time
-        if e['exif_datetime'] == None:
-            e['exif_datetime'] = os.path.getmtime(file_path_name)
-
-        gps = exifs.get_location()
-        lat = gps['latitude']
-        lon = gps['longitude']
-        e['latitude'] = round(lat, 4) if lat is not None else lat #TODO sqlite requires (None,) to insert NULL
-        e['longitude'] = round(lon, 4) if lon is not None else lon
-
-        #IPTC
-        e['tags'] = exifs.get_exif('IPTC Keywords')
-        e['title'] = exifs.get_exif('IPTC Object Name')
-        e['caption'] = exifs.get_exif('IPTC Caption/Abstract')
-
-
-        return e
-
+                with self.__db_lock:
+                    self.__db.executemany('UPDATE folder SET missing = 1 WHERE name = ?', [[name] for name in folder_names])
+                for name in folder_names:
+                    if name in folder_index:
+                        folder_index[name][1] = 1
+
+        # Files no longer on disk are already deleted as each modified folder is checked
+        # by __get_modified_files(), so only the folders need dealing with here
+        self.__purge_files = False
 
 # If being executed (instead of imported), kick it off...
 if __name__ == "__main__":
@@ -81,6 +81,7 @@ class InterfaceMQTT:
         self.__setup_sensor(client, "location_filter", "mdi:map-search", available_topic, entity_category="config")
         self.__setup_sensor(client, "tags_filter", "mdi:image-search", available_topic, entity_category="config")
         self.__setup_sensor(client, "image_counter", "mdi:camera-burst", available_topic, entity_category="diagnostic")
+        self.__setup_sensor(client, "scan_interval", "mdi:timer-sync", available_topic, entity_category="diagnostic")
         self.__setup_sensor(client, "image", "mdi:file-image", available_topic, has_attributes=True, entity_category="diagnostic")
 
         ## numbers
@@ -126,6 +127,7 @@ class InterfaceMQTT:
         self.__setup_button(client, "_next", "mdi:skip-next", available_topic)
 
         client.subscribe(self.__device_id + "/purge_files", qos=0) # close down without killing!
+        client.subscribe(self.__device_id + "/rescan", qos=0)
         client.subscribe(self.__device_id + "/stop", qos=0) # close down without killing!
 
     def __setup_sensor(self, client, topic, icon, available_topic, has_attributes=False, entity_category=None):
@@ -403,6 +405,10 @@ class InterfaceMQTT:
         elif message.topic == self.__device_id + "/purge_files":
             self.__controller.purge_files()
 
+        # check pic_dir for changes now
+        elif message.topic == self.__device_id + "/rescan":
+            self.__controller.rescan()
+
         # stop loops and end program
         elif message.topic == self.__device_id + "/stop":
             self.__controller.stop()
@@ -435,6 +441,8 @@ class InterfaceMQTT:
         sensor_state_payload["directory"] = actual_dir
         # image counter sensor
         sensor_state_payload["image_counter"] = str(self.__controller.get_number_of_files())
+        # seconds between checks of pic_dir
+        sensor_state_payload["scan_interval"] = self.__controller.scan_interval
         # date_from
         sensor_state_payload["date_from"] = int(self.__controller.date_from)
         # date_to
@@ -4,9 +4,13 @@ import numpy as np
 import random
 import logging
 import time
+from collections import OrderedDict
 
 class MatImage:
 
+    MAT_CACHE_SIZE = 6 # colorized mats, each up to the full display size
+    PATCH_CACHE_SIZE = 24 # rendered nine-patch overlays
+
     # region Constructor
 
     def __init__(self, display_size, mat_type = None, outer_mat_color = None,
@@ -35,6 +39,11 @@ class MatImage:
         self.__9patch_inner_shadow = Ninepatch('{0}/9_patch_inner_shadow.png'.format(resource_folder))
         self.__9patch_highlight = Ninepatch('{0}/9_patch_highlight.png'.format(resource_folder))
 
+        # --- Caches, so matting a picture is mostly just compositing ---
+        self.__texture_resized = None # (display_size, grayscale texture resized to it)
+        self.__mat_cache = OrderedDict() # (color, use_texture, size) -> mat, least recently used first
+        self.__patch_cache = OrderedDict() # (patch name, width, height) -> rendered overlay
+
     # endregion Constructor
 
     # region Public Properties
@@ -120,14 +129,18 @@ class MatImage:
 
     # region Public Methods
 
-    def mat_image(self, images):
+    def mat_image(self, images, palette=None):
+        # palette is the result of get_palette() for images[0] if it's already known
 
         # Randomly pick a mat type from those specified by the User
         mat_type = random.choice(self.mat_type)
 
         # If a mat color wasn't specified, get one
         if not self.outer_mat_color:
-            self.__outer_mat_color_save = self.__get_outer_mat_color(images[0])
+            if palette:
+                self.__outer_mat_color_save = tuple(palette[0])
+            else:
+                self.__outer_mat_color_save = self.__get_outer_mat_color(images[0])
         else:
             self.__outer_mat_color_save = tuple(self.outer_mat_color)
 
@@ -196,7 +209,7 @@ class MatImage:
             self.__add_image_outline(image, color2)
             image = ImageOps.expand(image, border_width)
             self.__add_image_outline(image, color, outline_width=border_width)
-            highlight = self.__9patch_highlight.render(image.width, image.height)
+            highlight = self.__render_patch('highlight', self.__9patch_highlight, image.width, image.height)
             image.paste(highlight, (0,0), highlight)
             image = self.__add_drop_shadow(image)
             final_images.append(image)
@@ -288,9 +301,7 @@ class MatImage:
 
 
     def __get_outer_mat_color(self, image):
-        k = KmeansNp(k=3, max_iterations=10, size=100)
-        colors = k.run(image)
-        return tuple(colors[0])
+        return get_palette(image)[0]
 
 
     """def __get_least_gray_color(self, colors):
@@ -308,15 +319,45 @@ class MatImage:
         return tuple(map(lambda c: int(c * fractional_percent), rgb_color))
 
 
-    def __get_colorized_mat(self, color, use_texture):
+    def __get_colorized_mat(self, color, use_texture, size=None):
+        # Returns a new mat image of size (default the display size) which the caller can paste onto.
+        # The texture is only resized when the display size changes and the colorized mats are kept
+        # in an LRU cache as, unless the color is picked from each picture, they are mostly the same
+        if size is None:
+            size = self.display_size
+        key = (tuple(int(c) for c in color), bool(use_texture), tuple(size))
+        mat_img = self.__mat_cache.get(key)
+        if mat_img is not None:
+            self.__mat_cache.move_to_end(key)
+            return mat_img.copy()
         if use_texture:
-            mat_img = self.__mat_texture.copy()
-            mat_img = mat_img.resize(self.display_size, resample=Image.BICUBIC)
-            mat_img = ImageOps.colorize(mat_img, black="black", white=color)
+            if self.__texture_resized is None or self.__texture_resized[0] != self.display_size:
+                self.__texture_resized = (self.display_size,
+                                          self.__mat_texture.resize(self.display_size, resample=Image.BICUBIC))
+            mat_img = self.__texture_resized[1]
+            if mat_img.size != key[2]:
+                mat_img = mat_img.crop((0, 0) + key[2])
+            mat_img = ImageOps.colorize(mat_img, black="black", white=key[0])
         else:
-            mat_img = Image.new('RGB', self.display_size, color)
-
-        return mat_img
+            mat_img = Image.new('RGB', key[2], key[0])
+        self.__mat_cache[key] = mat_img
+        if len(self.__mat_cache) > MatImage.MAT_CACHE_SIZE:
+            self.__mat_cache.popitem(last=False)
+        return mat_img.copy()
+
+
+    def __render_patch(self, name, patch, width, height):
+        # Ninepatch.render() results are only pasted from, never changed, so can be shared
+        key = (name, width, height)
+        overlay = self.__patch_cache.get(key)
+        if overlay is not None:
+            self.__patch_cache.move_to_end(key)
+            return overlay
+        overlay = patch.render(width, height)
+        self.__patch_cache[key] = overlay
+        if len(self.__patch_cache) > MatImage.PATCH_CACHE_SIZE:
+            self.__patch_cache.popitem(last=False)
+        return overlay
 
 
     def __get_inner_mat(self, size):
@@ -328,8 +369,7 @@ class MatImage:
         else:
             color = tuple(self.inner_mat_color)
 
-        mat = self.__get_colorized_mat(color, self.inner_mat_use_texture)
-        mat = mat.crop((0, 0, w, h))
+        mat = self.__get_colorized_mat(color, self.inner_mat_use_texture, (w, h))
 
         return mat
 
@@ -337,13 +377,13 @@ class MatImage:
     def __add_outer_bevel(self, image, expand = True):
         if expand:
             image = ImageOps.expand(image, 5)
-        outer_bevel_image = self.__9patch_bevel.render(image.width, image.height)
+        outer_bevel_image = self.__render_patch('bevel', self.__9patch_bevel, image.width, image.height)
         image.paste(outer_bevel_image, (0,0), outer_bevel_image)
         return image
 
 
     def __add_inner_shadow(self, image):
-        inner_shadow_image = self.__9patch_inner_shadow.render(image.width, image.height)
+        inner_shadow_image = self.__render_patch('inner_shadow', self.__9patch_inner_shadow, image.width, image.height)
         image.paste(inner_shadow_image, (0,0), inner_shadow_image)
         return image
 
@@ -353,7 +393,7 @@ class MatImage:
             # Calculate the outline color from the mat_color
             brightness = sum(mat_base_color[0:3]) / 3
             outline_color_offset = 30 if brightness < 127 else -30
-            outline_color = tuple(map(lambda x: x + outline_color_offset, mat_base_color))
+            outline_color = tuple(map(lambda x: max(0, min(255, x + outline_color_offset)), mat_base_color))
         else:
             outline_color = mat_base_color
 
@@ -365,7 +405,7 @@ class MatImage:
     def __add_drop_shadow(self, image):
         shadow_offset = 15
         mod_image = Image.new('RGBA', (image.width + shadow_offset, image.height + shadow_offset), (0,0,0,0))
-        shadow_image = self.__9patch_drop_shadow.render(mod_image.width, mod_image.height)
+        shadow_image = self.__render_patch('drop_shadow', self.__9patch_drop_shadow, mod_image.width, mod_image.height)
         mod_image.paste(shadow_image, (0,0), shadow_image)
         mod_image.paste(image, (0,0))
         return mod_image
@@ -494,59 +534,120 @@ class Kmeans(object):
         return True"""
 
 class KmeansNp:
-    def __init__(self, k=3, max_iterations=5, min_distance=5.0, size=200):
+    """Finds the k main colors of an image by k-means clustering of the pixels of a thumbnail.
+
+    Distances are squared and in float32, and the centroids are updated with np.bincount. The
+    starting centroids are chosen by k-means++ from a fixed seed so the same picture always gives
+    the same colors. If batch_size is given each iteration only uses that many randomly chosen
+    pixels (mini-batch k-means), which is only worth it for thumbnails much bigger than the default.
+    """
+    SEED = 0
+
+    def __init__(self, k=3, max_iterations=5, min_distance=5.0, size=200, batch_size=None):
         self.k = k
         self.max_iterations = max_iterations
         self.min_distance = min_distance
         self.size = (size, size)
+        self.batch_size = batch_size
 
     def run(self, image, start_clusters=None):
-        image = image.copy()
-        image.thumbnail(self.size)
-        im = np.array(image, dtype=float)[:,:,:3]
-        # following section can be used to give the clusters location as well as colour proximity
-        #(ix0, ix1) = np.indices(im.shape[:2]) # vert,horiz pixel locations
-        #ix0.shape = ix0.shape + (1,) # make same dim as im
-        #ix1.shape = ix1.shape + (1,) # make same dim as im
-        #im = np.append(im, ix0, axis=2) # TODO multiply by scale rel to rgb scale
-        #im = np.append(im, ix1, axis=2) # im now r,g,b,u,v
-        d = im.shape[-1] # 3 or 5 if u,v added
-        im = im.reshape(-1, d) #NB need to use floats to avoid coercing to uint8 scrambling subtractions
-        n = len(im)
+        scale = min(self.size[0] / image.width, self.size[1] / image.height)
+        if scale < 1.0: # same as image.thumbnail() without copying the whole image first
+            image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                                 resample=Image.BICUBIC, reducing_gap=2.0)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        im = np.asarray(image, dtype=np.float32).reshape(-1, 3)
+        rng = np.random.default_rng(KmeansNp.SEED)
         if start_clusters is None:
-            centroids = im[np.random.choice(np.arange(n), self.k)]
+            centroids = self.__seed(im, rng)
         else:
-            centroids = np.array(start_clusters, dtype=float)
-        old_centroids = centroids.copy()
-        for i in range(self.max_iterations):
-            im.shape = (1, n, d) # add dimension to allow broadcasting
-            centroids.shape = (self.k, 1, d) # ditto
-            dists = (((im - centroids) ** 2).sum(axis=2)) ** 0.5 # euclidean distance - manhattan might be fine and faster
-            ix = np.argmin(dists, axis=0) # indices of nearest centroid for each pixel
-            im.shape = (n, d) # reduce dimensions for mean
-            centroids.shape = (self.k, d) # ditto
-            counts = np.unique(ix, return_counts=True)[1] # count the number of each index
-            to_keep = [] # discard any centroids with no pixels nearest to them
-            for j in range(self.k): # write back average location of all nearest pixels
-                j_pixels = im[ix == j] # view into im where ix points to centroid j
-                if len(j_pixels) > 0: # error if try to get mean zero length array TODO remove groups with few pixels?
-                    centroids[j] = j_pixels.mean(axis=0)
-                    to_keep.append(j)
-            if len(to_keep) < len(centroids): # this will be relatively rare
-                for j in to_keep[::-1]: # delete in reverse order of index
-                    centroids = np.delete(centroids, j, axis=0)
-                    old_centroids = np.delete(old_centroids, j, axis=0)
-            movement = ((((centroids - old_centroids) ** 2).sum(axis=1)) ** 0.5).max()
-            if movement < self.min_distance:
-                break
-            old_centroids = centroids.copy()
+            centroids = np.array(start_clusters, dtype=np.float32)[:, :3]
+        if self.batch_size and self.batch_size < len(im):
+            centroids = self.__mini_batch(im, centroids, rng)
+        else:
+            centroids = self.__full_batch(im, centroids)
 
-        c_max, c_min = centroids[:,:3].max(axis=1), centroids[:,:3].min(axis=1) # max, min for each centroid
-        #c_lum = 0.5 * (c_max + c_min)
-        #c_sat = (c_max - c_min) / (255.0 - np.abs(c_lum * 2.0 - 255.0)) # should check for lum == 255
+        c_max, c_min = centroids.max(axis=1), centroids.min(axis=1) # max, min for each centroid
         c_sat = c_max - c_min # value used previously includes element of lum TODO bias more to lighter using (1.5 * c_max - c_min)
-        ix_order = np.argsort(c_sat)[::-1] # indices to sorted values - reversed
-        return centroids[ix_order, :3].astype(np.uint8)
+        ix_order = np.argsort(c_sat, kind='stable')[::-1] # indices to sorted values - reversed
+        return centroids[ix_order].astype(np.uint8)
+
+    def __full_batch(self, im, centroids):
+        min_d2 = self.min_distance ** 2
+        for _ in range(self.max_iterations):
+            ix = _nearest(im, centroids)
+            counts = np.bincount(ix, minlength=len(centroids))
+            keep = counts > 0 # discard any centroids with no pixels nearest to them
+            new_centroids = _sums(im, ix, len(centroids))[keep] / counts[keep, np.newaxis]
+            movement = ((new_centroids - centroids[keep]) ** 2).sum(axis=1).max()
+            centroids = new_centroids.astype(np.float32)
+            if movement < min_d2:
+                break
+        return centroids
+
+    def __mini_batch(self, im, centroids, rng):
+        # each centroid moves towards the mean of its pixels in the batch by the fraction of
+        # all the pixels it has been given so far that were in this batch
+        min_d2 = self.min_distance ** 2
+        totals = np.zeros(len(centroids))
+        for _ in range(self.max_iterations):
+            batch = im[rng.integers(len(im), size=self.batch_size)]
+            ix = _nearest(batch, centroids)
+            counts = np.bincount(ix, minlength=len(centroids))
+            totals += counts
+            hit = counts > 0
+            step = (_sums(batch, ix, len(centroids))[hit] / counts[hit, np.newaxis] - centroids[hit]) \
+                    * (counts[hit] / totals[hit])[:, np.newaxis]
+            centroids[hit] += step.astype(np.float32)
+            if (step ** 2).sum(axis=1).max() < min_d2:
+                break
+        return centroids[totals > 0]
+
+    def __seed(self, im, rng):
+        # k-means++ i.e. each new centroid is a pixel picked with probability proportional to its
+        # squared distance from the nearest centroid already chosen
+        centroids = [im[rng.integers(len(im))]]
+        d2 = ((im - centroids[0]) ** 2).sum(axis=1, dtype=np.float64) # rng.choice needs p to sum to 1 accurately
+        for _ in range(1, self.k):
+            total = d2.sum()
+            if total <= 0.0: # fewer distinct colors than k
+                break
+            centroids.append(im[rng.choice(len(im), p=d2 / total)])
+            d2 = np.minimum(d2, ((im - centroids[-1]) ** 2).sum(axis=1, dtype=np.float64))
+        return np.array(centroids, dtype=np.float32)
+
+
+def _nearest(im, centroids):
+    # index of the nearest centroid for each pixel using |p - c|^2 = |p|^2 - 2p.c + |c|^2 and,
+    # as |p|^2 is the same for every centroid, leaving it out
+    d2 = (centroids ** 2).sum(axis=1) - 2.0 * (im @ centroids.T)
+    return d2.argmin(axis=1)
+
+def _sums(im, ix, k):
+    # (k, 3) totals of the pixels nearest to each centroid
+    return np.stack([np.bincount(ix, weights=im[:, c], minlength=k) for c in range(im.shape[1])], axis=1)
+
+PALETTE_SIZE = 100 # pixels, the thumbnail the palette is worked out from
+
+def get_palette(image):
+    """Returns the main colors of image as a list of (r, g, b) ints, most colorful first. The first
+    is used for the outer mat unless a color is set in the configuration. ImageCache stores this in
+    the db for each picture so that normally it's only worked out once.
+    """
+    colors = KmeansNp(k=3, max_iterations=10, size=PALETTE_SIZE).run(image)
+    return [tuple(int(c) for c in color) for color in colors] # not numpy uint8 which would overflow in sums
+
+def palette_to_text(palette):
+    return ' '.join('#{:02x}{:02x}{:02x}'.format(*color) for color in palette)
+
+def palette_from_text(text):
+    # the palette saved by palette_to_text() or None if there isn't one (i.e. NULL in the db)
+    try:
+        return [tuple(int(color[i:i + 2], 16) for i in (1, 3, 5)) for color in text.split()] or None
+    except (AttributeError, ValueError):
+        return None
+
 
 if __name__ == "__main__":
 
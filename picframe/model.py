@@ -54,6 +54,10 @@ DEFAULT_CONFIG = {
         'menu_text_sz': 40,
         'menu_autohide_tm': 10.0,
         'geo_suppress_list': [],
+        'prefetch_num': 2,
+        'texture_history': 4,
+        'frame_cache_dir': '',
+        'frame_cache_mb': 500,
     },
     'model': {
 
@@ -72,8 +76,15 @@ DEFAULT_CONFIG = {
         'locale': 'en_US.utf8',
         'key_list': [['tourism','amenity','isolated_dwelling'],['suburb','village'],['city','county'],['region','state','province'],['country']],
         'geo_key': 'this_needs_to@be_changed',  # use your email address
+        'geo_backend': 'nominatim',             # or 'offline' to use geo_gazetteer
+        'geo_gazetteer': '~/picframe_data/data/cities1000.txt',  # GeoNames dump used by the 'offline' geo_backend
+        'geo_rate': 1.0,                        # most location lookups per second
+        'geo_radius': 100.0,                    # metres within which photos share one location lookup
         'db_file': '~/picframe_data/data/pictureframe.db3',
         'portrait_pairs': False,
+        'scan_workers': 1,
+        'use_inotify': False,
+        'scan_process': False,
         'deleted_pictures': '~/DeletedPictures',
         'log_level': 'WARNING',
         'log_file': '',
@@ -115,7 +126,7 @@ class Pic: #TODO could this be done more elegantly with namedtuple
                  f_number=0, exposure_time=None, iso=0, focal_length=None,
                  make=None, model=None, lens=None, rating=None, latitude=None,
                  longitude=None, width=0, height=0, is_portrait=0, location=None, title=None,
-                 caption=None, tags=None):
+                 caption=None, tags=None, palette=None):
         self.fname = fname
         self.last_modified = last_modified
         self.file_id = file_id
@@ -138,6 +149,7 @@ class Pic: #TODO could this be done more elegantly with namedtuple
         self.tags=tags
         self.caption=caption
         self.title=title
+        self.palette=palette
 
 
 class Model:
@@ -178,6 +190,7 @@ class Model:
         self.__num_run_through = 0
 
         model_config = self.get_model_config() # alias for brevity as used several times below
+        viewer_config = self.get_viewer_config()
         try:
             locale.setlocale(locale.LC_TIME, model_config['locale'])
         except:
@@ -185,12 +198,25 @@ class Model:
         self.__pic_dir = os.path.expanduser(model_config['pic_dir'])
         self.__subdirectory = os.path.expanduser(model_config['subdirectory'])
         self.__load_geoloc = model_config['load_geoloc']
-        self.__geo_reverse = geo_reverse.GeoReverse(model_config['geo_key'], key_list=self.get_model_config()['key_list'])
+        if model_config['geo_backend'] == 'offline':
+            self.__geo_reverse = geo_reverse.OfflineGeoReverse(model_config['geo_gazetteer'],
+                                                               key_list=model_config['key_list'])
+        else:
+            self.__geo_reverse = geo_reverse.GeoReverse(model_config['geo_key'], key_list=self.get_model_config()['key_list'],
+                                                        rate=model_config['geo_rate'])
         self.__image_cache = image_cache.ImageCache(self.__pic_dir,
                                                     model_config['follow_links'],
                                                     os.path.expanduser(model_config['db_file']),
-                                                    self.__geo_reverse,
-                                                    model_config['portrait_pairs'])
+                                                    self.__geo_reverse if self.__load_geoloc else None,
+                                                    model_config['portrait_pairs'],
+                                                    model_config['scan_workers'],
+                                                    model_config['use_inotify'],
+                                                    model_config['geo_radius'],
+                                                    model_config['scan_process'],
+                                                    # the scanner only needs the mat palettes if the mat color
+                                                    # is picked automatically
+                                                    (str(viewer_config['mat_images']).lower() not in ('false', 'no', 'off')
+                                                     and not viewer_config['outer_mat_color']))
         self.__deleted_pictures = model_config['deleted_pictures']
         self.__no_files_img = os.path.expanduser(model_config['no_files_img'])
         self.__sort_cols = model_config['sort_cols']
@@ -271,8 +297,15 @@ class Model:
             return
         self.__where_clauses[key] = value
 
-    def pause_looping(self, val):
-        self.__image_cache.pause_looping(val)
+    def pause_looping(self, val, transition_seconds=None):
+        # transition_seconds is how long the display is in transition for at each change. The scanning
+        # threads are held for all of it unless the next transition follows too soon for them to get
+        # anything done in between, when they're let go once it has lasted that long
+        max_seconds = None
+        if (transition_seconds is not None
+                and self.time_delay - transition_seconds < image_cache.ImageCache.PAUSE_RUN_SECONDS):
+            max_seconds = transition_seconds
+        self.__image_cache.pause_looping(val, max_seconds)
 
     def stop_image_chache(self):
         self.__image_cache.stop()
@@ -280,6 +313,16 @@ class Model:
     def purge_files(self):
         self.__image_cache.purge_files()
 
+    def rescan(self):
+        self.__image_cache.rescan()
+
+    def set_palette(self, file_id, palette):
+        self.__image_cache.set_palette(file_id, palette)
+
+    @property
+    def scan_interval(self):
+        return self.__image_cache.scan_interval
+
     def get_directory_list(self):
         _, root = os.path.split(self.__pic_dir)
         actual_dir = root
@@ -362,6 +405,28 @@ class Model:
         self.__current_pics = (pic1, pic2)
         return self.__current_pics
 
+    def get_upcoming_pics(self, num):
+        # picture sets that get_next_file() is expected to return next, found without moving
+        # along the list or updating the display stats. Used to prepare images ahead of time
+        upcoming = []
+        if self.__reload_files:
+            return upcoming # the list is about to change so anything found now would be wasted
+        file_list = self.__file_list[self.__file_index:self.__file_index + num]
+        if len(file_list) < num and not (self.shuffle and
+                                         self.__num_run_through + 1 >= self.get_model_config()['reshuffle_num']):
+            # get_next_file() will go back to the start of the list without reshuffling it
+            file_list += self.__file_list[:min(num - len(file_list), self.__file_index)]
+        for file_ids in file_list:
+            pics = [None, None]
+            for i, file_id in enumerate(file_ids):
+                pic_row = self.__image_cache.peek_file_info(file_id)
+                pics[i] = Pic(**pic_row) if pic_row is not None else None
+            if pics[0] is None:
+                pics = [pics[1], None]
+            if pics[0] is not None:
+                upcoming.append(tuple(pics))
+        return upcoming
+
     def get_number_of_files(self):
         #return self.__number_of_files
         #return sum(1 for pics in self.__file_list for pic in pics if pic is not None)
@@ -1,22 +1,30 @@
 import logging
 import os
+import threading
+from collections import OrderedDict
 
 import pi3d
 from PIL import ImageFilter, Image
 
-from picframe import get_image_meta, mat_image
+from picframe import get_image_meta, mat_image, frame_cache
 
 
 class TextureProvider:
 
+    BLUR_WIDTH = 128 # pixels, the blurred background for blur_edges is made at this width then scaled up
+    BLUR_CACHE_SIZE = 32 # blurred backgrounds kept at BLUR_WIDTH for pictures that come round again
+    SAMPLE_SIZE_MARGIN = 1.25 # images are scaled down to the size drawn if more than this much bigger
+
     def __init__(self, config):
         self.__logger = logging.getLogger("viewer_display.TextureProvider")
 
         self.__blur_amount = config['blur_amount']
         self.__blur_zoom = max(1.0, config['blur_zoom'])
-        self.__blur_edges = config['blur_edges']
+        self.__blur_edges = config['blur_edges'] and not config['kenburns'] # as in ViewerDisplay
+        self.__fit = config['fit'] and not config['kenburns']
 
         self.__edge_alpha = config['edge_alpha']
+        self.__blur_cache = OrderedDict() # (pics key, image size, box) -> small blurred background
 
         self.__mat_images, self.__mat_images_tol = self.__get_mat_image_control_values(config['mat_images'])
         self.__mat_type = config['mat_type']
@@ -28,6 +36,27 @@ class TextureProvider:
         self.__inner_mat_use_texture = config['inner_mat_use_texture']
         self.__mat_resource_folder = os.path.expanduser(config['mat_resource_folder'])
 
+        # images are prepared ahead of time on a worker thread so that the render thread
+        # only has to create the texture. The worker is started in set_display()
+        self.__prefetch_num = max(0, int(config['prefetch_num']))
+        self.__prefetch_cond = threading.Condition()
+        self.__prefetch_wanted = [] # list of (key, pics) tuples in the order they will be needed
+        self.__prefetched = {} # key -> prepared PIL image, or None if it couldn't be loaded
+        self.__found_palettes = [] # (file_id, palette text) worked out here as the scanner hadn't
+        self.__settings_changes = 0 # so an image being prepared when the settings change is thrown away
+        self.__keep_looping = True
+        self.__prefetch_thread = None
+
+        # the textures of the pictures shown most recently, so going back to one is instant and it looks
+        # the same (i.e. the same random mat). Only used by the render thread but held by __prefetch_cond
+        # too as prefetch() leaves out anything that's in it
+        self.__history_num = max(0, int(config['texture_history']))
+        self.__history = OrderedDict() # key -> pi3d.Texture, least recently shown first
+
+        # prepared images can be kept on disk, the cache is created in set_display() once the size is known
+        self.__frame_cache_dir = config['frame_cache_dir']
+        self.__frame_cache_mb = config['frame_cache_mb']
+        self.__frame_cache = None
 
     def set_matting_images(self, val): # needs to cope with "true", "ON", 0, "0.2" etc.
         try:
@@ -39,6 +68,12 @@ class TextureProvider:
         except: # ignore exceptions, error handling is done in following function
             pass
         self.__mat_images, self.__mat_images_tol = self.__get_mat_image_control_values(val)
+        with self.__prefetch_cond: # anything prepared already may have been matted, or not, the other way
+            self.__settings_changes += 1
+            self.__prefetch_wanted = []
+            self.__prefetched.clear()
+            self.__history.clear()
+            self.__blur_cache = OrderedDict() # replaced, not cleared, as the prefetch thread may be using it
 
     def get_matting_images(self):
         if self.__mat_images and self.__mat_images_tol > 0:
@@ -77,47 +112,170 @@ class TextureProvider:
             inner_mat_border=self.__inner_mat_border,
             outer_mat_use_texture=self.__outer_mat_use_texture,
             inner_mat_use_texture=self.__inner_mat_use_texture)
+        if self.__frame_cache_dir:
+            config_key = (self.__display_width, self.__display_height, self.__fit, self.__blur_amount, self.__blur_zoom,
+                          self.__blur_edges, self.__edge_alpha, self.__mat_type, self.__outer_mat_color,
+                          self.__inner_mat_color, self.__outer_mat_border, self.__inner_mat_border,
+                          self.__outer_mat_use_texture, self.__inner_mat_use_texture, self.__mat_resource_folder)
+            self.__frame_cache = frame_cache.FrameCache(self.__frame_cache_dir, self.__frame_cache_mb, config_key)
+        if self.__prefetch_thread is None:
+            self.__prefetch_thread = threading.Thread(target=self.__prefetch_loop, daemon=True)
+            self.__prefetch_thread.start()
+
+    @property
+    def prefetch_num(self):
+        return self.__prefetch_num
+
+    def prefetch(self, pics_list):
+        """Set the picture sets expected to be shown next, in the order they will be needed.
+        Anything already prepared that isn't in this list (i.e. after next, back or a change
+        of filter) is discarded.
+        """
+        with self.__prefetch_cond:
+            self.__prefetch_wanted = [(self.__get_key(pics), pics) for pics in pics_list[:self.__prefetch_num]
+                                        if pics[0] is not None and self.__get_key(pics) not in self.__history]
+            wanted_keys = [key for (key, _pics) in self.__prefetch_wanted]
+            for key in list(self.__prefetched):
+                if key not in wanted_keys:
+                    del self.__prefetched[key]
+            self.__prefetch_cond.notify_all()
+
+    def stop(self):
+        with self.__prefetch_cond:
+            self.__keep_looping = False
+            self.__prefetch_cond.notify_all()
+        if self.__prefetch_thread is not None:
+            self.__prefetch_thread.join()
 
     def tex_load(self, pics):
+        key = self.__get_key(pics)
+        with self.__prefetch_cond:
+            tex = self.__history.get(key)
+            if tex is not None: # shown recently
+                self.__history.move_to_end(key)
+                self.__prefetched.pop(key, None)
+                self.__prefetch_wanted = [(k, p) for (k, p) in self.__prefetch_wanted if k != key]
+                return tex
+            # not prefetched so put it at the front of the queue and wait (again if set_matting_images()
+            # dropped it from the queue meanwhile)
+            while key not in self.__prefetched and self.__keep_looping:
+                if all(wanted_key != key for (wanted_key, _pics) in self.__prefetch_wanted):
+                    self.__prefetch_wanted.insert(0, (key, pics))
+                    self.__prefetch_cond.notify_all()
+                self.__prefetch_cond.wait()
+            im = self.__prefetched.pop(key, None)
+            self.__prefetch_wanted = [(k, p) for (k, p) in self.__prefetch_wanted if k != key]
+        if im is None:
+            return None
+        try:
+            tex = pi3d.Texture(im, blend=True, m_repeat=True, free_after_load=True)
+            #tex = pi3d.Texture(im, blend=True, m_repeat=True, automatic_resize=config.AUTO_RESIZE,
+            #                    mipmap=config.AUTO_RESIZE, free_after_load=True) # poss try this if still some artifacts with full resolution
+        except Exception as e:
+            self.__logger.warning("Can't create tex from file: \"%s\" or \"%s\"", pics[0].fname, pics[1])
+            self.__logger.warning("Cause: %s", e)
+            tex = None
+        if tex is not None and self.__history_num > 0:
+            with self.__prefetch_cond:
+                self.__history[key] = tex
+                while len(self.__history) > self.__history_num: # dropped textures are freed once not shown
+                    self.__history.popitem(last=False)
+        return tex
+
+    def get_found_palettes(self):
+        # the palettes worked out since the last call, to be saved so it's not done again
+        with self.__prefetch_cond:
+            (found_palettes, self.__found_palettes) = (self.__found_palettes, [])
+        return found_palettes
+
+    def __get_key(self, pics):
+        return tuple((pic.fname, pic.last_modified) if pic is not None else None for pic in pics)
+
+    def __prefetch_loop(self):
+        while True:
+            with self.__prefetch_cond:
+                job = self.__get_next_job()
+                while job is None and self.__keep_looping:
+                    self.__prefetch_cond.wait()
+                    job = self.__get_next_job()
+                if not self.__keep_looping:
+                    break
+                settings_changes = self.__settings_changes
+            (key, pics) = job
+            try:
+                im = self.__prepare_image(pics)
+            except Exception as e: # must still be stored as None or tex_load() would wait for it forever
+                self.__logger.warning("Can't prepare image from file: \"%s\" or \"%s\"", pics[0].fname, pics[1])
+                self.__logger.warning("Cause: %s", e)
+                im = None
+            with self.__prefetch_cond:
+                if (settings_changes == self.__settings_changes and
+                        any(wanted_key == key for (wanted_key, _pics) in self.__prefetch_wanted)):
+                    self.__prefetched[key] = im # otherwise invalidated while it was being prepared
+                self.__prefetch_cond.notify_all()
+
+    def __get_next_job(self):
+        for (key, pics) in self.__prefetch_wanted:
+            if key not in self.__prefetched:
+                return (key, pics)
+        return None
+
+    def __prepare_image(self, pics):
+        # everything up to the texture creation is done here, on the prefetch thread, unless
+        # the same pictures have been prepared before with the same settings
+        if self.__frame_cache is None:
+            return self.__create_image(pics)
+        cache_key = (self.__get_key(pics), self.__mat_images, self.__mat_images_tol)
+        im = self.__frame_cache.get(cache_key)
+        if im is None:
+            im = self.__create_image(pics)
+            if im is not None:
+                self.__frame_cache.put(cache_key, im)
+        return im
+
+    def __create_image(self, pics):
         size = (self.__display_width, self.__display_height)
         try:
-            # Load the image(s) and correct their orientation as necessary
+            # Load the image(s) and correct their orientation as necessary. A single picture is only
+            # decoded at the size it will be drawn, pairs once they're put together
             if pics[0]:
-                im = get_image_meta.GetImageMeta.get_image_object(pics[0].fname)
+                load_size = size
+                if not pics[1] and pics[0].width > 0 and pics[0].height > 0:
+                    pic_size = (pics[0].width, pics[0].height)
+                    matted = self.__mat_images and self.__get_aspect_diff(size, pic_size)[2] > self.__mat_images_tol
+                    load_size = self.__get_sample_size(pic_size, size, fit=matted)
+                im = self.__load_image(pics[0], load_size)
                 if im is None:
                     return None
-                if pics[0].orientation != 1:
-                    im = self.__orientate_image(im, pics[0])
 
             if pics[1]:
-                im2 = get_image_meta.GetImageMeta.get_image_object(pics[1].fname)
+                im2 = self.__load_image(pics[1], size)
                 if im2 is None:
                     return None
-                if pics[1].orientation != 1:
-                     im2 = self.__orientate_image(im2, pics[1])
 
             screen_aspect, image_aspect, diff_aspect = self.__get_aspect_diff(size, im.size)
 
             if self.__mat_images and diff_aspect > self.__mat_images_tol:
+                palette = mat_image.palette_from_text(pics[0].palette) # found by the scanner
+                if palette is None and not self.__outer_mat_color and pics[0].file_id:
+                    palette = mat_image.get_palette(im)
+                    with self.__prefetch_cond:
+                        self.__found_palettes.append((pics[0].file_id, mat_image.palette_to_text(palette)))
                 if not pics[1]:
-                    im = self.__matter.mat_image((im,))
+                    im = self.__matter.mat_image((im,), palette)
                 else:
-                    im = self.__matter.mat_image((im, im2))
+                    im = self.__matter.mat_image((im, im2), palette)
             else:
                 if pics[1]: #i.e portrait pair
                     im = self.__create_image_pair(im, im2)
 
 
 
-            (w, h) = im.size
-            # no longer allow automatic resize to be turned off - but GL_MAX_TEXTURE_SIZE used by Texture
-            #max_dimension = MAX_SIZE # TODO changing MAX_SIZE causes serious crash on linux laptop!
-            #if not self.__auto_resize: # turned off for 4K display - will cause issues on RPi before v4
-            #    max_dimension = 3840 # TODO check if mipmapping should be turned off with this setting.
-            #if w > max_dimension:
-            #    im = im.resize((max_dimension, int(h * max_dimension / w)), resample=Image.BICUBIC)
-            #elif h > max_dimension:
-            #    im = im.resize((int(w * max_dimension / h), max_dimension), resample=Image.BICUBIC)
+            # Nothing much bigger than the shader will sample is uploaded to the GPU (matted images are
+            # already the display size). Images only a little bigger aren't worth the time to scale
+            (w, h) = self.__get_sample_size(im.size, size)
+            if w * TextureProvider.SAMPLE_SIZE_MARGIN < im.width:
+                im = im.resize((w, h), resample=Image.LANCZOS, reducing_gap=3.0)
 
             screen_aspect, image_aspect, diff_aspect = self.__get_aspect_diff(size, im.size)
 
@@ -129,31 +287,57 @@ class TextureProvider:
                     (w, h) =  (round(size[0] / sc_b / self.__blur_zoom), round(size[1] / sc_b / self.__blur_zoom))
                     (x, y) = (round(0.5 * (im.size[0] - w)), round(0.5 * (im.size[1] - h)))
                     box = (x, y, x + w, y + h)
-                    blr_sz = (int(x * 512 / size[0]) for x in size)
-                    im_b = im.resize(size, resample=0, box=box).resize(blr_sz)
-                    im_b = im_b.filter(ImageFilter.GaussianBlur(self.__blur_amount))
-                    im_b = im_b.resize(size, resample=Image.BICUBIC)
-                    im_b.putalpha(round(255 * self.__edge_alpha))  # to apply the same EDGE_ALPHA as the no blur method.
+                    im_b = self.__get_blur_background(pics, im, box, size)
                     im = im.resize((int(x * sc_f) for x in im.size), resample=Image.BICUBIC)
                     """resize can use Image.LANCZOS (alias for Image.ANTIALIAS) for resampling
-                    for better rendering of high-contranst diagonal lines. NB downscaled large
-                    images are rescaled near the start of this try block if w or h > max_dimension
-                    so those lines might need changing too.
+                    for better rendering of high-contranst diagonal lines. NB large images have
+                    already been scaled down to fit, with LANCZOS, above so this only scales up
+                    images smaller than the display.
                     """
                     im_b.paste(im, box=(round(0.5 * (im_b.size[0] - im.size[0])),
                                         round(0.5 * (im_b.size[1] - im.size[1]))))
                     im = im_b # have to do this as paste applies in place
-            tex = pi3d.Texture(im, blend=True, m_repeat=True, free_after_load=True)
-            #tex = pi3d.Texture(im, blend=True, m_repeat=True, automatic_resize=config.AUTO_RESIZE,
-            #                    mipmap=config.AUTO_RESIZE, free_after_load=True) # poss try this if still some artifacts with full resolution
         except Exception as e:
             self.__logger.warning("Can't create tex from file: \"%s\" or \"%s\"", pics[0].fname, pics[1])
             self.__logger.warning("Cause: %s", e)
-            tex = None
+            im = None
             #raise # only re-raise errors here while debugging
-        return tex
+        return im
 
 
+    def __get_blur_background(self, pics, im, box, size):
+        # The part of im in box blurred and scaled to size. It's made at BLUR_WIDTH in one step from
+        # the (already reduced) image, as blurring leaves no detail that a bigger working size would
+        # keep, so the only pass at the display size is the final bilinear scaling up. The small
+        # versions are kept for pictures that come round again
+        key = (self.__get_key(pics), im.size, box)
+        blur_cache = self.__blur_cache
+        im_b = blur_cache.get(key)
+        if im_b is not None:
+            blur_cache.move_to_end(key)
+        else:
+            blr_sz = (TextureProvider.BLUR_WIDTH, max(1, round(TextureProvider.BLUR_WIDTH * size[1] / size[0])))
+            im_b = im.resize(blr_sz, resample=Image.BILINEAR, box=box, reducing_gap=2.0).convert('RGB')
+            # blur_amount is the radius for a background 512 pixels wide
+            im_b = im_b.filter(ImageFilter.GaussianBlur(self.__blur_amount * blr_sz[0] / 512))
+            blur_cache[key] = im_b
+            if len(blur_cache) > TextureProvider.BLUR_CACHE_SIZE:
+                blur_cache.popitem(last=False)
+        im_b = im_b.resize(size, resample=Image.BILINEAR) # quicker without the alpha channel
+        im_b.putalpha(round(255 * self.__edge_alpha))  # to apply the same EDGE_ALPHA as the no blur method.
+        return im_b
+
+    def __get_sample_size(self, image_size, screen_size, fit=False):
+        # The size the slide shader draws an image of image_size at i.e. scaled to fit inside the
+        # screen or, without fit, to fill it (kenburns only pans so needs no more than that). With
+        # blur_edges, or matting, the image is fitted inside the screen before it gets to the shader
+        (w, h) = image_size
+        if fit or self.__fit or self.__blur_edges:
+            scale = min(screen_size[0] / w, screen_size[1] / h)
+        else:
+            scale = max(screen_size[0] / w, screen_size[1] / h)
+        return (max(1, round(w * scale)), max(1, round(h * scale)))
+
     def __get_aspect_diff(self, screen_size, image_size):
         screen_aspect = screen_size[0] / screen_size[1]
         image_aspect = image_size[0] / image_size[1]
@@ -178,6 +362,17 @@ class TextureProvider:
         dst.paste(im2, (im1.width + sep, 0))
         return dst
 
+    def __load_image(self, pic, size):
+        # decode at reduced scale straight to display resolution then correct the orientation
+        # of the (now much smaller) bitmap. heif and heic images are already the right way up
+        ext = os.path.splitext(pic.fname)[1].lower()
+        if pic.orientation in (5, 6, 7, 8) and ext not in ('.heif','.heic'):
+            size = (size[1], size[0]) # the stored image will be rotated by 90 degrees
+        im = get_image_meta.GetImageMeta.get_image_object(pic.fname, size)
+        if im is not None and pic.orientation != 1:
+            im = self.__orientate_image(im, pic)
+        return im
+
     def __orientate_image(self, im, pic):
         ext = os.path.splitext(pic.fname)[1].lower()
         if ext  in ('.heif','.heic'): # heif and heic images are converted to PIL.Image obects and are alway in correct orienation
@@ -33,6 +33,8 @@ def parse_show_text(txt):
 
 class ViewerDisplay:
 
+    TRANSITION_LEAD_SECONDS = 5.0 # counts as in transition for this long before each change as well as the fade
+
     def __init__(self, config):
         self.__logger = logging.getLogger("viewer_display.ViewerDisplay")
         self.__edge_alpha = config['edge_alpha']
@@ -169,6 +171,16 @@ class ViewerDisplay:
     def get_matting_images(self):
         return self.__tex_provider.get_matting_images()
 
+    @property
+    def prefetch_num(self):
+        return self.__tex_provider.prefetch_num
+
+    def prefetch(self, pics_list):
+        self.__tex_provider.prefetch(pics_list)
+
+    def get_found_palettes(self):
+        return self.__tex_provider.get_found_palettes()
+
     @property
     def clock_is_on(self):
         return self.__show_clock
@@ -386,7 +398,7 @@ class ViewerDisplay:
                 self.__alpha = 1.0
             self.__slide.unif[44] = self.__alpha * self.__alpha * (3.0 - 2.0 * self.__alpha)
 
-        if (self.__next_tm - tm) < 5.0 or self.__alpha < 1.0:
+        if (self.__next_tm - tm) < ViewerDisplay.TRANSITION_LEAD_SECONDS or self.__alpha < 1.0:
             self.__in_transition = True  # set __in_transition True a few seconds *before* end of previous slide
         else:  # no transition effect safe to update database, resuffle etc
             self.__in_transition = False
@@ -429,4 +441,5 @@ class ViewerDisplay:
             (self.__sbg, self.__sfg) = (self.__sfg, self.__sbg)  # swap existing images over
 
     def slideshow_stop(self):
+        self.__tex_provider.stop()
         self.__display.destroy()
@@ -0,0 +1,104 @@
+"""Compares the time MatImage's KmeansNp takes to find the mat color with the implementation
+it replaced, on the same thumbnails. Run from the top folder with
+
+    python -m test.benchmark_kmeans [picture files...]
+
+It isn't collected by pytest.
+"""
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from picframe.mat_image import KmeansNp
+
+REPEATS = 20
+
+
+class OldKmeansNp:
+    # KmeansNp before it used bincount, squared float32 distances and k-means++ seeding
+    def __init__(self, k=3, max_iterations=5, min_distance=5.0, size=200):
+        self.k = k
+        self.max_iterations = max_iterations
+        self.min_distance = min_distance
+        self.size = (size, size)
+
+    def run(self, image, start_clusters=None):
+        image = image.copy()
+        image.thumbnail(self.size)
+        im = np.array(image, dtype=float)[:,:,:3]
+        d = im.shape[-1]
+        im = im.reshape(-1, d)
+        n = len(im)
+        if start_clusters is None:
+            centroids = im[np.random.choice(np.arange(n), self.k)]
+        else:
+            centroids = np.array(start_clusters, dtype=float)
+        old_centroids = centroids.copy()
+        for i in range(self.max_iterations):
+            im.shape = (1, n, d)
+            centroids.shape = (self.k, 1, d)
+            dists = (((im - centroids) ** 2).sum(axis=2)) ** 0.5
+            ix = np.argmin(dists, axis=0)
+            im.shape = (n, d)
+            centroids.shape = (self.k, d)
+            counts = np.unique(ix, return_counts=True)[1]
+            to_keep = []
+            for j in range(self.k):
+                j_pixels = im[ix == j]
+                if len(j_pixels) > 0:
+                    centroids[j] = j_pixels.mean(axis=0)
+                    to_keep.append(j)
+            if len(to_keep) < len(centroids):
+                for j in to_keep[::-1]:
+                    centroids = np.delete(centroids, j, axis=0)
+                    old_centroids = np.delete(old_centroids, j, axis=0)
+            movement = ((((centroids - old_centroids) ** 2).sum(axis=1)) ** 0.5).max()
+            if movement < self.min_distance:
+                break
+            old_centroids = centroids.copy()
+        c_max, c_min = centroids[:,:3].max(axis=1), centroids[:,:3].min(axis=1)
+        c_sat = c_max - c_min
+        ix_order = np.argsort(c_sat)[::-1]
+        return centroids[ix_order, :3].astype(np.uint8)
+
+
+def thumbnails(files, size):
+    thumbs = []
+    for fname in files:
+        im = Image.open(fname).convert('RGB')
+        im.thumbnail((size, size))
+        thumbs.append((os.path.basename(fname), im))
+    # and a smooth gradient and noise
+    x = np.linspace(0, 255, size, dtype=np.float32)
+    grad = np.stack(np.broadcast_arrays(x[np.newaxis, :], x[:, np.newaxis], 255 - x[np.newaxis, :]), axis=2)
+    thumbs.append(('gradient', Image.fromarray(grad.astype(np.uint8))))
+    thumbs.append(('noise', Image.effect_noise((size, size), 80).convert('RGB')))
+    return thumbs
+
+def bench(kmeans, thumbs):
+    tm = time.perf_counter()
+    for _ in range(REPEATS):
+        for (_name, im) in thumbs:
+            kmeans.run(im)
+    return (time.perf_counter() - tm) / REPEATS / len(thumbs)
+
+def main():
+    folder = os.path.dirname(__file__)
+    files = sys.argv[1:] or [os.path.join(folder, 'images', 'AlleExif.JPG'),
+                             os.path.join(folder, '..', 'picframe', 'data', 'no_pictures.jpg')]
+    for (size, batch_size) in ((100, None), (400, None), (400, 4096)):
+        thumbs = thumbnails(files, size)
+        old_tm = bench(OldKmeansNp(k=3, max_iterations=10, size=size), thumbs)
+        new_tm = bench(KmeansNp(k=3, max_iterations=10, size=size, batch_size=batch_size), thumbs)
+        print("size={:4d} batch_size={:5}  old {:7.2f}ms  new {:7.2f}ms  x{:.1f}".format(
+            size, str(batch_size), old_tm * 1000.0, new_tm * 1000.0, old_tm / new_tm))
+    new = KmeansNp(k=3, max_iterations=10, size=100)
+    for (name, im) in thumbnails(files, 100):
+        old_color = OldKmeansNp(k=3, max_iterations=10, size=100).run(im)[0]
+        print("{:16s} mat color old {}  new {}".format(name, old_color.tolist(), new.run(im)[0].tolist()))
+
+if __name__ == "__main__":
+    main()
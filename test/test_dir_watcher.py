@@ -0,0 +1,78 @@
+import os
+import shutil
+
+import pytest
+
+from picframe.dir_watcher import InotifyWatcher
+
+
+@pytest.fixture
+def watcher(tmp_path):
+    try:
+        watcher = InotifyWatcher(str(tmp_path))
+    except (OSError, AttributeError): # not linux
+        pytest.skip("inotify not available")
+    yield watcher
+    watcher.close()
+
+def test_new_file(tmp_path, watcher):
+    (tmp_path / 'sub').mkdir()
+    assert watcher.get_changed_folders() == ({str(tmp_path), str(tmp_path / 'sub')}, False, False)
+    (tmp_path / 'sub' / 'a.jpg').write_bytes(b'jpg')
+    assert watcher.get_changed_folders() == ({str(tmp_path / 'sub')}, False, False)
+    assert watcher.get_changed_folders() == (set(), False, False) # all drained
+
+def test_new_nested_folder(tmp_path, watcher):
+    # nested and its file are made before there's a watch on new, so they're found by walking it
+    os.makedirs(tmp_path / 'new' / 'nested')
+    (tmp_path / 'new' / 'nested' / 'a.jpg').write_bytes(b'jpg')
+    (changed, removed, overflow) = watcher.get_changed_folders()
+    assert changed >= {str(tmp_path), str(tmp_path / 'new'), str(tmp_path / 'new' / 'nested')}
+    assert not removed and not overflow
+    (tmp_path / 'new' / 'nested' / 'b.jpg').write_bytes(b'jpg') # and it's watched from now on
+    assert watcher.get_changed_folders() == ({str(tmp_path / 'new' / 'nested')}, False, False)
+
+def test_removed_folder(tmp_path, watcher):
+    os.makedirs(tmp_path / 'sub' / 'nested')
+    watcher.get_changed_folders()
+    shutil.rmtree(tmp_path / 'sub')
+    (changed, removed, overflow) = watcher.get_changed_folders()
+    assert removed and not overflow
+    os.makedirs(tmp_path / 'sub')
+    (changed, removed, overflow) = watcher.get_changed_folders()
+    assert str(tmp_path / 'sub') in changed and not removed # watched again
+    (tmp_path / 'sub' / 'a.jpg').write_bytes(b'jpg')
+    assert watcher.get_changed_folders() == ({str(tmp_path / 'sub')}, False, False)
+
+def test_symlink_cycle(tmp_path):
+    os.makedirs(tmp_path / 'pics' / 'a')
+    os.symlink(tmp_path / 'pics', tmp_path / 'pics' / 'a' / 'loop')
+    try:
+        watcher = InotifyWatcher(str(tmp_path / 'pics'), follow_links=True)
+    except (OSError, AttributeError):
+        pytest.skip("inotify not available")
+    try:
+        (tmp_path / 'pics' / 'b.jpg').write_bytes(b'jpg')
+        (tmp_path / 'pics' / 'a' / 'c.jpg').write_bytes(b'jpg')
+        # each folder is only watched once, by the path it was first found by
+        assert watcher.get_changed_folders() == ({str(tmp_path / 'pics'), str(tmp_path / 'pics' / 'a')}, False, False)
+    finally:
+        watcher.close()
+
+def test_root_replaced(tmp_path):
+    os.makedirs(tmp_path / 'pics' / 'sub')
+    try:
+        watcher = InotifyWatcher(str(tmp_path / 'pics'))
+    except (OSError, AttributeError):
+        pytest.skip("inotify not available")
+    try:
+        os.rename(tmp_path / 'pics', tmp_path / 'pics_x')
+        assert watcher.get_changed_folders()[2] # overflow so that everything is checked
+        (tmp_path / 'pics_x' / 'sub' / 'a.jpg').write_bytes(b'jpg') # no longer in the tree
+        assert watcher.get_changed_folders() == (set(), False, False)
+        (tmp_path / 'pics').mkdir()
+        assert watcher.get_changed_folders()[2] # back, and watched again
+        (tmp_path / 'pics' / 'b.jpg').write_bytes(b'jpg')
+        assert watcher.get_changed_folders() == ({str(tmp_path / 'pics')}, False, False)
+    finally:
+        watcher.close()
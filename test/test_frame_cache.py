@@ -0,0 +1,37 @@
+import os
+
+from PIL import Image
+
+from picframe.frame_cache import FrameCache
+
+
+def test_get_put(tmp_path):
+    cache = FrameCache(str(tmp_path), 10, (1920, 1080, 'mat'))
+    assert cache.get(('a.jpg', 1.0)) is None
+    cache.put(('a.jpg', 1.0), Image.new('RGB', (64, 48), (200, 100, 50)))
+    cache.put(('b.jpg', 1.0), Image.new('RGBA', (64, 48), (0, 0, 0, 128)))
+    im = cache.get(('a.jpg', 1.0))
+    assert im.size == (64, 48) and im.mode == 'RGB'
+    assert cache.get(('b.jpg', 1.0)).mode == 'RGBA'
+    assert cache.get(('a.jpg', 2.0)) is None # modified file
+    # a new instance with the same config finds them again
+    assert FrameCache(str(tmp_path), 10, (1920, 1080, 'mat')).get(('a.jpg', 1.0)) is not None
+
+def test_config_change_and_lru(tmp_path):
+    (tmp_path / 'other').mkdir() # not made by FrameCache so left alone
+    (tmp_path / 'frames_2019').mkdir()
+    cache = FrameCache(str(tmp_path), 10, (1920, 1080, 'mat'))
+    cache.put(('a.jpg', 1.0), Image.new('RGB', (64, 48)))
+    cache = FrameCache(str(tmp_path), 10, (1920, 1080, 'no mat'))
+    assert cache.get(('a.jpg', 1.0)) is None
+    left = set(os.listdir(tmp_path)) - {'frames_2019', 'other'}
+    assert len(left) == 1 and len(os.listdir(tmp_path)) == 3 # only the old cache removed
+
+    noise = Image.effect_noise((256, 256), 64).convert('RGB') # doesn't compress much
+    cache = FrameCache(str(tmp_path), 0.15, 'small')
+    for i in range(3):
+        cache.put(('{}.jpg'.format(i), 1.0), noise)
+        cache.get(('0.jpg', 1.0)) # keep using the first one
+    assert cache.get(('0.jpg', 1.0)) is not None
+    assert cache.get(('1.jpg', 1.0)) is None # least recently used
+    assert cache.get(('2.jpg', 1.0)) is not None
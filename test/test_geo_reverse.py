@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+from picframe.geo_reverse import GeoReverse, OfflineGeoReverse
+
+KEY_LIST = [['suburb', 'village'], ['city', 'county'], ['country']]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # answers like nominatim's reverse geocoding, lat=0 is in the sea and lat=-1 is a server error
+    protocol_version = 'HTTP/1.1' # keep-alive
+    connections = set()
+    requests = 0
+
+    def do_GET(self):
+        StandInHandler.connections.add(self.client_address)
+        StandInHandler.requests += 1
+        lat = float(parse_qs(urlsplit(self.path).query)['lat'][0])
+        if lat < 0:
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if lat == 0:
+            data = {'error': 'Unable to geocode'}
+        else:
+            data = {'type': 'FeatureCollection', 'features': [{'properties': {'address': {
+                'road': 'High Street', 'village': 'Ambridge', 'county': 'Borsetshire', 'country': 'UK'}}}]}
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def url():
+    StandInHandler.connections = set()
+    StandInHandler.requests = 0
+    server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    yield "http://127.0.0.1:{}/reverse?lat={{}}&lon={{}}&zoom={{}}&email={{}}&accept-language={{}}".format(
+        server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+def test_get_address(url):
+    geo = GeoReverse('me@example.com', key_list=KEY_LIST, rate=0, url=url)
+    assert geo.get_address(52.1, -1.7) == 'Ambridge, Borsetshire, UK'
+    assert geo.get_address(52.2, -1.7) == 'Ambridge, Borsetshire, UK'
+    geo.close()
+    assert StandInHandler.requests == 2
+    assert len(StandInHandler.connections) == 1 # connection kept alive
+
+def test_no_address_and_failure(url):
+    geo = GeoReverse('me@example.com', key_list=KEY_LIST, rate=0, url=url)
+    assert geo.get_address(0.0, 0.0) == ''
+    assert geo.get_address(-1.0, 0.0) is None
+    assert geo.get_address(52.1, -1.7) == 'Ambridge, Borsetshire, UK' # reconnects after the error
+    geo.close()
+    unreachable = GeoReverse('me@example.com', rate=0, url="http://127.0.0.1:1/?lat={}&lon={}&zoom={}&email={}&l={}")
+    assert unreachable.get_address(52.1, -1.7) is None
+
+def test_rate_limit(url):
+    geo = GeoReverse('me@example.com', key_list=KEY_LIST, rate=5.0, url=url)
+    tm = time.monotonic()
+    for _ in range(3):
+        geo.get_address(52.1, -1.7)
+    assert time.monotonic() - tm >= 0.4
+    geo.close()
+
+def test_offline(tmp_path):
+    rows = [(1, 'Ambridge', 52.10, -1.70, 'PPL', 'ENG', 500),
+            (2, 'Borchester', 52.30, -1.50, 'PPLA2', 'ENG', 20000),
+            (3, 'Paris', 48.85, 2.35, 'PPLC', '11', 2000000),
+            (4, 'Labasa', -16.4, 179.9, 'PPLA', 'N', 28000)]
+    with open(tmp_path / 'cities.txt', 'w') as f:
+        for (id, name, lat, lon, code, admin1, pop) in rows:
+            country = 'GB' if admin1 == 'ENG' else 'FR' if admin1 == '11' else 'FJ'
+            f.write('\t'.join([str(id), name, name, '', str(lat), str(lon), 'P', code, country, '', admin1,
+                               '', '', '', str(pop), '', '', 'tz', '2020-01-01']) + '\n')
+    with open(tmp_path / 'admin1CodesASCII.txt', 'w') as f:
+        f.write('GB.ENG\tEngland\tEngland\t1\nFR.11\tIle-de-France\tIle-de-France\t2\n')
+    with open(tmp_path / 'countryInfo.txt', 'w') as f:
+        f.write('#ISO\tISO3\n' + 'GB\tGBR\t826\tUK\tUnited Kingdom\tLondon\n' + 'FR\tFRA\t250\tFR\tFrance\tParis\n')
+    geo = OfflineGeoReverse(str(tmp_path / 'cities.txt'), key_list=KEY_LIST)
+    assert geo.get_address(52.11, -1.71) == 'Ambridge, United Kingdom'
+    assert geo.get_address(52.29, -1.49) == 'Borchester, United Kingdom'
+    assert geo.get_address(48.9, 2.3) == 'Paris, France'
+    assert geo.get_address(-16.4, -179.95) == 'Labasa, FJ' # across the date line, no country name
+    assert geo.get_address(0.0, 0.0) == '' # nowhere near
+    assert OfflineGeoReverse(str(tmp_path / 'missing.txt')).get_address(52.1, -1.7) is None
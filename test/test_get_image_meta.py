@@ -1,5 +1,6 @@
 import pytest
 import logging
+from PIL import Image
 
 
 from  picframe.get_image_meta import GetImageMeta
@@ -147,4 +148,30 @@ def test_exifs_heic():
         assert caption == None
 
     except:
-        pytest.fail("Unexpected exception")
\ No newline at end of file
+        pytest.fail("Unexpected exception")
+
+def test_get_image_size_from_header():
+    assert GetImageMeta.get_image_size("test/images/AlleExif.JPG") == (1920, 1200)
+    assert GetImageMeta.get_image_size("test/images/test3.HEIC") == (3024, 4032) # irot applied
+
+def test_get_image_size_png_and_fallback(tmp_path):
+    fname = str(tmp_path / "test.png")
+    Image.new("RGB", (33, 17)).save(fname)
+    assert GetImageMeta.get_image_size(fname) == (33, 17)
+    fname = str(tmp_path / "test.jpg") # not really a jpeg so PIL has to work it out
+    Image.new("RGB", (21, 12)).save(fname, format="BMP")
+    assert GetImageMeta.get_image_size(fname) == (21, 12)
+
+def test_iptc_from_jpeg_header():
+    exifs = GetImageMeta("test/images/AlleExif.JPG")
+    assert exifs.get_exif('IPTC Keywords') == "AidaPrima,Events,Kreuzfahrt,Land,"
+    assert exifs.get_size() == (1920, 1200)
+
+@pytest.mark.parametrize('mode', ['P', '1', 'I;16', 'L', 'RGBA'])
+def test_get_image_object_reduced(tmp_path, mode):
+    fname = str(tmp_path / 'image.png')
+    Image.new('RGB', (800, 600), (200, 100, 50)).convert(mode).save(fname)
+    for size in (None, (200, 150)):
+        image = GetImageMeta.get_image_object(fname, size)
+        assert image is not None and image.mode in ('RGB', 'RGBA')
+        assert image.size == ((800, 600) if size is None else (200, 150))
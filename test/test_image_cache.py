@@ -0,0 +1,222 @@
+import os
+import shutil
+import sqlite3
+import time
+
+from picframe.image_cache import ImageCache
+
+IMAGE = 'test/images/AlleExif.JPG'
+
+
+def wait_for(test, timeout=20.0):
+    tm = time.time()
+    while not test():
+        assert time.time() - tm < timeout, "timed out"
+        time.sleep(0.05)
+
+def later(path, seconds):
+    # folder times are compared to the second so move them on rather than wait
+    os.utime(path, (os.path.getmtime(path) + seconds,) * 2)
+
+def test_pause(tmp_path, monkeypatch):
+    monkeypatch.setattr(ImageCache, 'PAUSE_RUN_SECONDS', 0.5)
+    (tmp_path / 'pics').mkdir()
+    shutil.copy(IMAGE, tmp_path / 'pics' / 'a.jpg')
+    cache = ImageCache(str(tmp_path / 'pics'), False, str(tmp_path / 'db.db3'), None)
+    try:
+        wait_for(lambda: len(cache.query_cache("1")) == 1)
+        # a pause holds the scanning threads for as long as it lasts
+        cache.pause_looping(True)
+        shutil.copy(IMAGE, tmp_path / 'pics' / 'b.jpg')
+        later(tmp_path / 'pics', 10)
+        cache.rescan()
+        time.sleep(1.0)
+        assert len(cache.query_cache("1")) == 1
+        cache.pause_looping(False)
+        wait_for(lambda: len(cache.query_cache("1")) == 2)
+        # unless it's given a max_seconds (time_delay hardly longer than fade_time, so the display
+        # is always in transition)
+        cache.pause_looping(True, 0.5)
+        shutil.copy(IMAGE, tmp_path / 'pics' / 'c.jpg')
+        later(tmp_path / 'pics', 10)
+        cache.rescan()
+        wait_for(lambda: len(cache.query_cache("1")) == 3)
+    finally:
+        cache.stop()
+
+def test_palettes(tmp_path):
+    (tmp_path / 'pics').mkdir()
+    shutil.copy(IMAGE, tmp_path / 'pics' / 'a.jpg')
+    cache = ImageCache(str(tmp_path / 'pics'), False, str(tmp_path / 'db.db3'), None)
+    try:
+        wait_for(lambda: len(cache.query_cache("1")) == 1)
+        file_id = cache.query_cache("1")[0][0]
+        assert cache.get_file_info(file_id)['palette'] is None # mat color not picked automatically
+        cache.set_palette(file_id, '#ff0000') # as the display does when it has to work it out
+        cache.rescan()
+        wait_for(lambda: cache.get_file_info(file_id)['palette'] == '#ff0000')
+    finally:
+        cache.stop()
+    cache = ImageCache(str(tmp_path / 'pics2'), False, str(tmp_path / 'db2.db3'), None, palettes=True)
+    try:
+        shutil.copytree(tmp_path / 'pics', tmp_path / 'pics2')
+        cache.rescan()
+        wait_for(lambda: len(cache.query_cache("1")) == 1)
+        assert cache.get_file_info(cache.query_cache("1")[0][0])['palette'].startswith('#')
+    finally:
+        cache.stop()
+
+def test_removed_folder(tmp_path):
+    (tmp_path / 'pics' / 'sub').mkdir(parents=True)
+    shutil.copy(IMAGE, tmp_path / 'pics' / 'a.jpg')
+    shutil.copy(IMAGE, tmp_path / 'pics' / 'sub' / 'b.jpg')
+    cache = ImageCache(str(tmp_path / 'pics'), False, str(tmp_path / 'db.db3'), None)
+    try:
+        wait_for(lambda: len(cache.query_cache("1")) == 2)
+        shutil.rmtree(tmp_path / 'pics' / 'sub')
+        cache.rescan()
+        wait_for(lambda: len(cache.query_cache("1")) == 1) # flagged as missing
+        (tmp_path / 'pics' / 'sub').mkdir() # back again
+        shutil.copy(IMAGE, tmp_path / 'pics' / 'sub' / 'b.jpg')
+        cache.rescan()
+        wait_for(lambda: len(cache.query_cache("1")) == 2)
+    finally:
+        cache.stop()
+
+def file_rows(db_file):
+    with sqlite3.connect(db_file) as db:
+        return {row[0]: (row[1], row[2]) for row in db.execute('SELECT basename, file_id, last_modified FROM file')}
+
+def test_new_modified_and_deleted_files(tmp_path):
+    (tmp_path / 'pics').mkdir()
+    db_file = str(tmp_path / 'db.db3')
+    shutil.copy(IMAGE, tmp_path / 'pics' / 'a.jpg')
+    shutil.copy(IMAGE, tmp_path / 'pics' / 'b.jpg')
+    cache = ImageCache(str(tmp_path / 'pics'), False, db_file, None)
+    try:
+        wait_for(lambda: len(cache.query_cache("1")) == 2)
+        (a_id, a_tm) = file_rows(db_file)['a']
+        b_id = file_rows(db_file)['b'][0]
+
+        # new
+        shutil.copy(IMAGE, tmp_path / 'pics' / 'c.jpg')
+        later(tmp_path / 'pics', 10)
+        cache.rescan()
+        wait_for(lambda: len(cache.query_cache("1")) == 3)
+        assert file_rows(db_file)['c'][0] not in (a_id, b_id)
+
+        # modified (which doesn't change the folder's mtime so it's found when it's shown), updated
+        # in place so it keeps its file_id and stats
+        later(tmp_path / 'pics' / 'a.jpg', 10)
+        assert cache.get_file_info(a_id)['last_modified'] == a_tm
+        cache.rescan()
+        wait_for(lambda: file_rows(db_file)['a'][1] == a_tm + 10)
+        assert file_rows(db_file)['a'][0] == a_id
+        assert cache.get_file_info(a_id)['last_modified'] == a_tm + 10
+
+        # deleted, along with its meta record
+        os.remove(tmp_path / 'pics' / 'b.jpg')
+        later(tmp_path / 'pics', 20)
+        cache.rescan()
+        wait_for(lambda: 'b' not in file_rows(db_file))
+        assert file_rows(db_file)['a'][0] == a_id
+    finally:
+        cache.stop()
+    with sqlite3.connect(db_file) as db:
+        assert db.execute('SELECT COUNT(*) FROM meta WHERE file_id = ?', (b_id,)).fetchone()[0] == 0
+
+def test_migrate_v3_db(tmp_path):
+    (tmp_path / 'pics').mkdir()
+    db_file = str(tmp_path / 'db.db3')
+    ImageCache(str(tmp_path / 'pics'), False, db_file, None).stop()
+    # take it back to how schema v3 was, with a meta record orphaned by INSERT OR REPLACE
+    with sqlite3.connect(db_file) as db:
+        db.execute('ALTER TABLE location DROP COLUMN nearby')
+        db.execute('ALTER TABLE meta DROP COLUMN palette')
+        db.execute('UPDATE db_info SET schema_version = 3')
+        db.execute('INSERT INTO meta(file_id) VALUES(99)')
+    shutil.copy(IMAGE, tmp_path / 'pics' / 'a.jpg')
+    cache = ImageCache(str(tmp_path / 'pics'), False, db_file, None)
+    try:
+        wait_for(lambda: len(cache.query_cache("1")) == 1)
+        assert 'palette' in cache.get_column_names()
+    finally:
+        cache.stop()
+    with sqlite3.connect(db_file) as db:
+        assert db.execute('SELECT schema_version FROM db_info').fetchone()[0] == 6
+        assert db.execute('SELECT COUNT(*) FROM meta WHERE file_id = 99').fetchone()[0] == 0
+        assert 'nearby' in [row[1] for row in db.execute('PRAGMA table_info(location)')]
+
+def test_no_address_rows_cached(tmp_path):
+    (tmp_path / 'pics').mkdir()
+    db_file = str(tmp_path / 'db.db3')
+    shutil.copy(IMAGE, tmp_path / 'pics' / 'a.jpg') # has a gps position
+    cache = ImageCache(str(tmp_path / 'pics'), False, db_file, None)
+    try:
+        wait_for(lambda: len(cache.query_cache("1")) == 1)
+        file_id = cache.query_cache("1")[0][0]
+        assert cache.get_file_info(file_id)['location'] is None # not looked up yet so not cached
+        with sqlite3.connect(db_file) as db:
+            db.execute('INSERT INTO location (latitude, longitude, description) VALUES (25.1973, 55.2744, NULL)')
+        assert cache.get_file_info(file_id)['location'] is None # no address, now cached
+        with sqlite3.connect(db_file) as db:
+            db.execute('UPDATE location SET description = ?', ('Dubai',))
+        assert cache.get_file_info(file_id)['location'] is None # so the db isn't read again
+    finally:
+        cache.stop()
+
+class FakeGeoReverse:
+    def __init__(self):
+        self.calls = []
+
+    def get_address(self, lat, lon):
+        self.calls.append((lat, lon))
+        return "Looked up"
+
+    def close(self):
+        pass
+
+def add_locations(db_file, rows):
+    with sqlite3.connect(db_file) as db:
+        db.executemany('INSERT INTO location (latitude, longitude, description, nearby) VALUES (?, ?, ?, ?)', rows)
+
+def test_nearby_location(tmp_path):
+    (tmp_path / 'pics').mkdir()
+    db_file = str(tmp_path / 'db.db3')
+    cache = ImageCache(str(tmp_path / 'pics'), False, db_file, None, geo_radius=100.0)
+    try:
+        add_locations(db_file, [(25.1975, 55.2744, 'Marina', 0), # 22m from 25.1973, 55.2744
+                                (25.1990, 55.2744, 'Further', 0), # 190m
+                                (10.0, 10.0, 'Copied', 1),
+                                (-16.8, 179.9995, 'West of the line', 0), # 53m from -16.8, -179.9999
+                                (80.0, 55.0, 'No address', 0)])
+        nearby_location = cache._ImageCache__get_nearby_location
+        assert nearby_location(25.1973, 55.2744) == 'Marina'
+        assert nearby_location(25.1980, 55.2744) == 'Marina' # the nearest
+        assert nearby_location(25.1998, 55.2744) == 'Further'
+        assert nearby_location(25.2010, 55.2744) is None # out of range
+        assert nearby_location(10.0, 10.0001) is None # only looked up locations are copied
+        assert nearby_location(-16.8, -179.9999) == 'West of the line'
+        with sqlite3.connect(db_file) as db:
+            db.execute('UPDATE location SET description = NULL WHERE latitude = 80.0')
+        assert nearby_location(80.0, 55.0001) == "" # no address there either
+    finally:
+        cache.stop()
+
+def test_nearby_location_saved(tmp_path):
+    (tmp_path / 'pics').mkdir()
+    db_file = str(tmp_path / 'db.db3')
+    ImageCache(str(tmp_path / 'pics'), False, db_file, None).stop()
+    add_locations(db_file, [(25.1975, 55.2744, 'Marina', 0)])
+    shutil.copy(IMAGE, tmp_path / 'pics' / 'a.jpg') # at 25.1973, 55.2744
+    geo = FakeGeoReverse()
+    cache = ImageCache(str(tmp_path / 'pics'), False, db_file, geo, geo_radius=100.0)
+    try:
+        wait_for(lambda: len(cache.query_cache("1")) == 1)
+        file_id = cache.query_cache("1")[0][0]
+        wait_for(lambda: cache.get_file_info(file_id)['location'] == 'Marina') # asks for it to be looked up
+    finally:
+        cache.stop()
+    assert geo.calls == []
+    with sqlite3.connect(db_file) as db:
+        assert db.execute('SELECT description, nearby FROM location WHERE latitude = 25.1973').fetchone() == ('Marina', 1)
@@ -0,0 +1,36 @@
+import numpy as np
+from PIL import Image
+
+from picframe.mat_image import KmeansNp, get_palette, palette_to_text, palette_from_text
+
+
+def two_color_image():
+    im = np.zeros((300, 400, 3), dtype=np.uint8)
+    im[:, :300] = (200, 40, 40) # 3/4 red
+    im[:, 300:] = (40, 40, 200) # 1/4 blue
+    im += np.random.default_rng(1).integers(0, 10, im.shape, dtype=np.uint8) # a bit of noise
+    return Image.fromarray(im)
+
+def test_kmeans():
+    image = two_color_image()
+    colors = KmeansNp(k=3, max_iterations=10, size=100).run(image)
+    assert colors.dtype == np.uint8 and colors.shape[1] == 3
+    found = {tuple(int(c) // 20 for c in color) for color in colors}
+    assert (10, 2, 2) in found and (2, 2, 10) in found
+    # the same picture always gives the same colors
+    assert (KmeansNp(k=3, max_iterations=10, size=100).run(image) == colors).all()
+    assert image.size == (400, 300) # not changed by making the thumbnail
+
+def test_kmeans_mini_batch_and_single_color():
+    colors = KmeansNp(k=2, max_iterations=20, size=200, batch_size=500).run(two_color_image())
+    assert sorted(tuple(int(c) // 20 for c in color) for color in colors) == [(2, 2, 10), (10, 2, 2)]
+    colors = KmeansNp(k=3).run(Image.new('RGB', (50, 50), (10, 20, 30)))
+    assert colors.tolist() == [[10, 20, 30]] # only one distinct color so only one centroid
+
+def test_palette():
+    palette = get_palette(two_color_image())
+    assert palette[0][0] // 20 == 10 # the red is most colorful
+    text = palette_to_text(palette)
+    assert len(text.split()) == 3 and text.startswith('#c')
+    assert palette_from_text(text) == palette
+    assert palette_from_text(None) is None and palette_from_text('') is None and palette_from_text('#zz') is None
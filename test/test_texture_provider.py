@@ -0,0 +1,70 @@
+import copy
+import time
+
+import pytest
+from PIL import Image
+
+from picframe import model, texture_provider
+
+
+class FakeTexture: # pi3d.Texture needs a GL context
+    def __init__(self, im, **_kwargs):
+        self.size = im.size
+
+class FakeDisplay:
+    width = 640
+    height = 360
+
+@pytest.fixture
+def provider(monkeypatch):
+    monkeypatch.setattr(texture_provider.pi3d, 'Texture', FakeTexture)
+    config = copy.deepcopy(model.DEFAULT_CONFIG['viewer'])
+    config.update(mat_images=True, mat_resource_folder='picframe/data/mat', texture_history=2,
+                  frame_cache_dir=None)
+    provider = texture_provider.TextureProvider(config)
+    provider.set_display(FakeDisplay())
+    yield provider
+    provider.stop()
+
+@pytest.fixture
+def pics(tmp_path):
+    pics = []
+    for i in range(4):
+        fname = str(tmp_path / '{}.jpg'.format(i))
+        Image.new('RGB', (400, 300), (i * 60, 100, 200 - i * 40)).save(fname)
+        pics.append((model.Pic(fname, 1.0, i + 1, width=400, height=300), None))
+    return pics
+
+def test_prefetch(provider, pics):
+    provider.prefetch(pics[:2])
+    tm = time.time()
+    while len(provider._TextureProvider__prefetched) < 2: # prepared on the prefetch thread
+        assert time.time() - tm < 20.0, "timed out"
+        time.sleep(0.05)
+    tex = provider.tex_load(pics[0])
+    assert tex.size == (640, 360) # matted to the display size
+    assert provider.tex_load(pics[2]).size == (640, 360) # not prefetched so prepared while waiting
+    assert provider._TextureProvider__prefetched.keys() == {provider._TextureProvider__get_key(pics[1])}
+
+def test_history(provider, pics):
+    shown = [provider.tex_load(p) for p in pics[:3]]
+    assert provider.tex_load(pics[2]) is shown[2] and provider.tex_load(pics[1]) is shown[1]
+    assert provider.tex_load(pics[0]) is not shown[0] # only the last texture_history kept
+    provider.prefetch([pics[0], pics[3]])
+    assert [pics for (_key, pics) in provider._TextureProvider__prefetch_wanted] == [pics[3]]
+
+def test_set_matting_images(provider, pics):
+    tex = provider.tex_load(pics[0])
+    provider.prefetch(pics[1:3])
+    provider.set_matting_images('false')
+    assert not provider._TextureProvider__prefetched and not provider._TextureProvider__prefetch_wanted
+    unmatted = provider.tex_load(pics[0])
+    assert unmatted is not tex and unmatted.size == (400, 300) # not from before the change
+
+def test_prepare_fails(provider, pics):
+    def fail(_pics):
+        raise RuntimeError("not an OSError")
+    provider._TextureProvider__prepare_image = fail
+    assert provider.tex_load(pics[0]) is None # rather than waiting forever
+    del provider._TextureProvider__prepare_image
+    assert provider.tex_load(pics[1]).size == (640, 360) # and the prefetch thread is still going